@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "fn"))
+
+import func
+import oci
+from replay_oci import ReplayStore
+from simulated_oci import SimulatedBackend
+
+
+def install(backend):
+    """ Points the clients of serverless/fn/func.py to a simulated backend
+
+    Parameters:
+    backend - The SimulatedBackend
+
+    Returns:
+    None
+    """
+    func.CLIENT_CLASSES.update(backend.client_classes())
+    func.signer = backend.signer()
+    func.clients.clear()
+    func.region_subscriptions = None
+    func.expire_ad_cache()
+
+
+def run_benchmark(backend, config):
+    """ Runs func.run end to end against a simulated backend
+
+    Parameters:
+    backend - The SimulatedBackend
+    config - The function config
+
+    Returns:
+    A dict with the wall time, API calls, retries and peak memory of the run
+    """
+    install(backend)
+    tracemalloc.start()
+    start = time.perf_counter()
+    limits, stats = func.run(config)
+    wall_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    backend_stats = backend.stats()
+    return {
+        "wall_seconds": round(wall_time, 3),
+        "api_calls": backend_stats["api_calls"],
+        "total_api_calls": backend_stats["total_api_calls"],
+        "retries": backend_stats["total_throttled"],
+        "published_messages": backend_stats["published"],
+        "peak_memory_bytes": peak,
+        "checked_limits": stats["incremental"]["evaluated"],
+        "function_stats": stats
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Benchmarks serverless/fn/func.py against a simulated Limits/Identity/ONS/Object Storage backend")
+
+    parser.add_argument("-regions", dest="regions", type=int, default=1,
+                        help="The number of subscribed regions \n")
+    parser.add_argument("-services", dest="services", type=int, default=20,
+                        help="The number of services \n")
+    parser.add_argument("-limits_per_service", dest="limits_per_service", type=int, default=100,
+                        help="The number of limit definitions of every service \n")
+    parser.add_argument("-ads", dest="ads", type=int, default=3,
+                        help="The number of availability domains of every region \n")
+    parser.add_argument("-global_ratio", dest="global_ratio", type=float, default=0.0,
+                        help="The share of the limits with a GLOBAL scope \n")
+    parser.add_argument("-latency", dest="latency", type=float, default=0.05,
+                        help="The latency of every call in seconds \n")
+    parser.add_argument("-jitter", dest="jitter", type=float, default=0.0,
+                        help="The maximum random latency added to every call in seconds \n")
+    parser.add_argument("-throttle_rate", dest="throttle_rate", type=float, default=0.0,
+                        help="The probability of a call failing with 429 \n")
+    parser.add_argument("-seed", dest="seed", type=int, default=42,
+                        help="The seed of the simulated tenancy \n")
+    parser.add_argument("-percentage", dest="percentage", type=str, default="90",
+                        help="The threshold percentage \n")
+    parser.add_argument("-config", dest="config", type=str, default="{}",
+                        help="Extra function config as a JSON object, for example '{\"concurrency\": \"8\"}' \n")
+    parser.add_argument("-record", dest="record", type=str,
+                        help="Records the OCI responses of the run to this store file. Uses the tenancy of -config_file when it is given, the simulated backend otherwise \n")
+    parser.add_argument("-replay", dest="replay", type=str,
+                        help="Runs against the responses recorded in this store file instead of the simulated backend \n")
+    parser.add_argument("-replay_speed", dest="replay_speed", type=float, default=0.0,
+                        help="Replays every call with its recorded duration times this factor (defaults to 0, as fast as possible) \n")
+    parser.add_argument("-config_file", dest="config_file", type=str,
+                        help="The OCI config file of the tenancy recorded with -record \n")
+    parser.add_argument("-profile", dest="profile", type=str, default=oci.config.DEFAULT_PROFILE,
+                        help="The profile of the OCI config file \n")
+    parser.add_argument("-output", dest="output", type=str,
+                        help="Appends the result as a JSON line to this file \n")
+
+    args = parser.parse_args()
+
+    if args.replay:
+        backend = ReplayStore(args.replay, speed=args.replay_speed)
+    elif args.record and args.config_file:
+        func.use_config_file(args.config_file, args.profile)
+        backend = ReplayStore(args.record, "record", func.CLIENT_CLASSES,
+                              func.signer, func.default_config["region"])
+    else:
+        backend = SimulatedBackend(regions=args.regions, services=args.services, limits_per_service=args.limits_per_service,
+                                   ad_count=args.ads, global_limit_ratio=args.global_ratio, latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate, seed=args.seed)
+        if args.record:
+            backend = ReplayStore(args.record, "record",
+                                  backend.client_classes(), backend.signer())
+    config = {"percentage": args.percentage,
+              "topic_id": "ocid1.onstopic.oc1..simulated"}
+    config.update(json.loads(args.config))
+
+    try:
+        result = run_benchmark(backend, config)
+    finally:
+        if isinstance(backend, ReplayStore) and backend.mode == "record":
+            backend.save()
+    result["parameters"] = vars(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as myfile:
+            myfile.write(json.dumps(result) + "\n")
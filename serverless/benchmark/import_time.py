@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+FUNCTIONS = {
+    "fn": os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fn"),
+    "main": os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main")
+}
+
+MEASURE = """
+import sys
+import time
+start = time.perf_counter()
+import func
+func.handler
+print(time.perf_counter() - start, len(sys.modules))
+"""
+
+
+def measure_import(directory):
+    """ Imports a function in a fresh interpreter, like a cold start of its container
+
+    Parameters:
+    directory - The directory of the function
+
+    Returns:
+    A tuple with the seconds it took to import the function and get its handler and the number of loaded modules
+    """
+    output = subprocess.run([sys.executable, "-c", MEASURE], cwd=directory,
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[-2]), int(output[-1])
+
+
+def slowest_imports(directory, count=10):
+    """ Lists the modules imported by a function that take the most time, from python -X importtime
+
+    Parameters:
+    directory - The directory of the function
+    count - The number of imports returned
+
+    Returns:
+    A list of (module, cumulative seconds) tuples, for the modules imported directly by func.py
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import func"], cwd=directory,
+                            capture_output=True, text=True, check=True).stderr
+    children = []
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, module = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((module.strip(), int(cumulative) / 1000000))
+        elif depth == 0:
+            if module.strip() == "func":
+                imports = children
+            children = []
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def run_benchmark(functions, repeat=5):
+    """ Measures the cold import time of the handlers
+
+    Parameters:
+    functions - The names of the functions, keys of FUNCTIONS
+    repeat - The number of fresh interpreters started for every function
+
+    Returns:
+    A dict with the min, median and max import seconds, the loaded modules and the slowest imports of every function
+    """
+    result = {}
+    for name in functions:
+        samples = sorted(measure_import(FUNCTIONS[name])
+                         for index in range(repeat))
+        result[name] = {
+            "min_seconds": round(samples[0][0], 4),
+            "median_seconds": round(samples[len(samples) // 2][0], 4),
+            "max_seconds": round(samples[-1][0], 4),
+            "modules": samples[0][1],
+            "slowest_imports": [[module, round(seconds, 4)] for module, seconds in slowest_imports(FUNCTIONS[name])]
+        }
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Measures the cold start import time of the handlers of serverless/fn and serverless/main")
+
+    parser.add_argument("-functions", dest="functions", type=str, default="fn,main",
+                        help="Comma separated functions to measure \n")
+    parser.add_argument("-repeat", dest="repeat", type=int, default=5,
+                        help="The number of fresh interpreters started for every function \n")
+    parser.add_argument("-output", dest="output", type=str,
+                        help="Appends the result as a JSON line to this file \n")
+
+    args = parser.parse_args()
+
+    result = run_benchmark(args.functions.split(','), args.repeat)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as myfile:
+            myfile.write(json.dumps(result) + "\n")
@@ -0,0 +1,194 @@
+import gzip
+import os
+import pickle
+import threading
+import time
+import types
+
+import oci
+
+
+class ReplayStore(object):
+    """ Records the responses of OCI clients to a file and replays them without a tenancy
+
+    In record mode the clients returned by client_classes wrap the real clients and keep
+    the status, headers, data and duration of every call, keyed by service, region, method
+    and arguments. In replay mode the same calls return the recorded responses in the order
+    they were recorded, or raise the recorded ServiceError. Calls whose arguments were never
+    recorded (an object written with a new timestamp for example) get the last response
+    recorded for the same method.
+
+    The store is a gzip compressed pickle, only replay stores you recorded yourself.
+    """
+
+    def __init__(self, path, mode="replay", client_classes=None, signer=None, region=None, speed=0.0):
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = {}
+        self.published = 0
+        self.positions = {}
+        if mode == "record":
+            self.real_client_classes = dict(client_classes)
+            self.real_signer = signer
+            self.responses = {}
+            self.meta = {"tenancy_id": signer.tenancy_id, "region": region or getattr(signer, "region", None),
+                         "services": list(client_classes)}
+        else:
+            with gzip.open(path, "rb") as store:
+                content = pickle.load(store)
+            self.meta = content["meta"]
+            self.responses = content["responses"]
+        self.latest = {}
+        for key, responses in self.responses.items():
+            self.latest[key[:3]] = responses[-1]
+
+    def save(self):
+        """ Writes the recorded responses to the store file """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.lock:
+            content = {"meta": self.meta, "responses": self.responses}
+        with gzip.open(self.path, "wb") as store:
+            pickle.dump(content, store, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def call_key(service, region, method, args, kwargs):
+        arguments = [repr(arg) for arg in args]
+        arguments.extend("{}={!r}".format(name, kwargs[name]) for name in sorted(kwargs)
+                         if name not in ["retry_strategy", "opc_request_id"])
+        return (service, region, method, ",".join(arguments))
+
+    @staticmethod
+    def capture(response):
+        data = response.data
+        if data != None and not hasattr(data, "swagger_types") and hasattr(data, "content"):
+            data = types.SimpleNamespace(content=data.content)
+        headers = {name.lower(): value for name,
+                   value in (response.headers or {}).items()}
+        return (response.status, headers, data)
+
+    def count(self, method, status=None):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if status == 429:
+                self.throttled[method] = self.throttled.get(method, 0) + 1
+            if method == "publish_message" and status == None:
+                self.published += 1
+
+    def record(self, key, call, args, kwargs):
+        start = time.perf_counter()
+        try:
+            response = call(*args, **kwargs)
+        except oci.exceptions.ServiceError as e:
+            entry = ("error", (e.status, e.code, dict(e.headers or {}), e.message),
+                     time.perf_counter() - start)
+            with self.lock:
+                self.responses.setdefault(key, []).append(entry)
+            self.count(key[2], e.status)
+            raise
+        entry = ("response", self.capture(response),
+                 time.perf_counter() - start)
+        with self.lock:
+            self.responses.setdefault(key, []).append(entry)
+        self.count(key[2])
+        return response
+
+    def replay(self, key):
+        with self.lock:
+            responses = self.responses.get(key)
+            if responses != None:
+                position = self.positions.get(key, 0)
+                self.positions[key] = position + 1
+                entry = responses[min(position, len(responses) - 1)]
+            else:
+                entry = self.latest.get(key[:3])
+        if entry == None:
+            raise KeyError(
+                "No recorded response for {} {} {}".format(*key[:3]))
+        kind, value, seconds = entry
+        if self.speed > 0:
+            time.sleep(seconds * self.speed)
+        if kind == "error":
+            self.count(key[2], value[0])
+            status, code, headers, message = value
+            raise oci.exceptions.ServiceError(status, code, headers, message)
+        self.count(key[2])
+        status, headers, data = value
+        return oci.response.Response(status, headers, data, None)
+
+    def client_classes(self, services=None):
+        """ Returns client classes that record or replay the calls of the clients
+
+        Parameters:
+        services: The names of the clients, the keys of the CLIENT_CLASSES that are replaced. None uses the ones of the recording
+
+        Returns:
+        A dict of service name -> client factory
+        """
+        store = self
+        if services == None:
+            services = self.meta["services"]
+
+        def client_class(service):
+            def create(config, signer=None, **kwargs):
+                # Clients with an explicit endpoint (functions invoke) are keyed by it, the
+                # region of their config depends on how the run was configured
+                region = kwargs.get("service_endpoint") or config.get(
+                    "region") or store.meta["region"]
+                client = None
+                if store.mode == "record":
+                    client = store.real_client_classes[service](
+                        config, signer=signer, **kwargs)
+                return RecordedClient(store, service, region, client)
+            return create
+
+        return {service: client_class(service) for service in services}
+
+    def signer(self):
+        """ Returns the signer used to record, or a stand-in with its tenancy when replaying """
+        if self.mode == "record":
+            return self.real_signer
+        return types.SimpleNamespace(tenancy_id=self.meta["tenancy_id"], region=self.meta["region"])
+
+    def stats(self):
+        """ Returns the call and throttle counters, like SimulatedBackend.stats """
+        with self.lock:
+            return {
+                "api_calls": dict(self.calls),
+                "total_api_calls": sum(self.calls.values()),
+                "throttled": dict(self.throttled),
+                "total_throttled": sum(self.throttled.values()),
+                "published": self.published
+            }
+
+
+class RecordedClient(object):
+    """ Stand-in for an OCI client whose method calls go through a ReplayStore """
+
+    def __init__(self, store, service, region, client=None):
+        self.store = store
+        self.service = service
+        self.region = region
+        self.client = client
+
+    def __getattr__(self, name):
+        if self.client != None:
+            attribute = getattr(self.client, name)
+            if not callable(attribute):
+                return attribute
+        elif name.startswith("_") or name == "base_client":
+            raise AttributeError(name)
+
+        def call(client, *args, **kwargs):
+            key = ReplayStore.call_key(
+                client.service, client.region, name, args, kwargs)
+            if client.store.mode == "record":
+                return client.store.record(key, getattr(client.client, name), args, kwargs)
+            return client.store.replay(key)
+        # Named and bound like a client method, so func.api_call finds the operation and the region
+        call.__name__ = name
+        return types.MethodType(call, self)
@@ -0,0 +1,217 @@
+import random
+import threading
+import time
+import types
+
+import oci
+
+
+class SimulatedBackend(object):
+    """ In memory stand-in for the Limits, Identity, Notifications and Object Storage services
+
+    Every call sleeps for latency seconds (plus up to jitter seconds) and fails with a 429
+    with probability throttle_rate. Calls and throttles are counted per operation.
+    """
+
+    def __init__(self, regions=1, services=20, limits_per_service=100, ad_count=3, ad_limit_ratio=0.3, global_limit_ratio=0.0,
+                 zero_limit_ratio=0.2, unsupported_ratio=0.05, latency=0.05, jitter=0.0, throttle_rate=0.0, seed=42):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.tenancy_id = "ocid1.tenancy.oc1..simulated"
+        self.namespace = "simulated"
+        self.calls = {}
+        self.throttled = {}
+        self.objects = {}
+        self.published = []
+
+        region_names = ["us-ashburn-1", "us-phoenix-1", "eu-frankfurt-1", "uk-london-1", "ap-tokyo-1",
+                        "ap-sydney-1", "sa-saopaulo-1", "ca-toronto-1", "eu-zurich-1", "ap-mumbai-1"]
+        self.regions = []
+        for index in range(regions):
+            if index < len(region_names):
+                name = region_names[index]
+            else:
+                name = "xx-simulated-{}".format(index)
+            self.regions.append(oci.identity.models.RegionSubscription(
+                region_key=name[:3].upper(), region_name=name, status="READY", is_home_region=index == 0))
+
+        self.ads = ["Simulated:AD-{}".format(index + 1)
+                    for index in range(ad_count)]
+        self.definitions = []
+        self.values = {}
+        self.usage = {}
+        for service_index in range(services):
+            service_name = "service-{}".format(service_index)
+            for limit_index in range(limits_per_service):
+                limit_name = "limit-{}".format(limit_index)
+                scope = self.random.random()
+                if scope < ad_limit_ratio:
+                    scope_type = "AD"
+                elif scope < ad_limit_ratio + global_limit_ratio:
+                    scope_type = "GLOBAL"
+                else:
+                    scope_type = "REGION"
+                self.definitions.append(oci.limits.models.LimitDefinitionSummary(
+                    name=limit_name, service_name=service_name, scope_type=scope_type,
+                    is_resource_availability_supported=self.random.random() >= unsupported_ratio))
+                for ad in (self.ads if scope_type == "AD" else [None]):
+                    if self.random.random() < zero_limit_ratio:
+                        value = 0
+                    else:
+                        value = self.random.choice([1, 2, 5, 10, 50, 100, 1000])
+                    used = self.random.randint(0, value)
+                    self.values[(service_name, limit_name, ad)] = (
+                        scope_type, value)
+                    self.usage[(service_name, limit_name, ad)] = (
+                        used, value - used)
+
+    def call(self, operation, data=None, headers=None):
+        """ Simulates the latency and throttling of a call and wraps data in an oci Response """
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttle = self.random.random() < self.throttle_rate
+            delay = self.latency + self.random.random() * self.jitter
+        time.sleep(delay)
+        if throttle:
+            with self.lock:
+                self.throttled[operation] = self.throttled.get(
+                    operation, 0) + 1
+            raise oci.exceptions.ServiceError(
+                429, "TooManyRequests", {}, "Simulated throttle for {}".format(operation))
+        return oci.response.Response(200, headers or {}, data, None)
+
+    def stats(self):
+        """ Returns the call and throttle counters """
+        with self.lock:
+            return {
+                "api_calls": dict(self.calls),
+                "total_api_calls": sum(self.calls.values()),
+                "throttled": dict(self.throttled),
+                "total_throttled": sum(self.throttled.values()),
+                "published": len(self.published)
+            }
+
+    def client_classes(self):
+        """ Returns client classes that can replace the CLIENT_CLASSES of serverless/fn/func.py """
+        backend = self
+
+        def client_class(cls):
+            def create(config, signer=None, **kwargs):
+                return cls(backend, config.get("region", backend.regions[0].region_name))
+            return create
+
+        return {
+            "limits": client_class(SimulatedLimitsClient),
+            "quotas": client_class(SimulatedLimitsClient),
+            "search": client_class(SimulatedLimitsClient),
+            "identity": client_class(SimulatedIdentityClient),
+            "notifications": client_class(SimulatedNotificationClient),
+            "object_storage": client_class(SimulatedObjectStorageClient)
+        }
+
+    def signer(self):
+        """ Returns a stand-in for the resource principal signer """
+        return types.SimpleNamespace(tenancy_id=self.tenancy_id, region=self.regions[0].region_name)
+
+
+class SimulatedClient(object):
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+
+class SimulatedLimitsClient(SimulatedClient):
+
+    def list_services(self, compartment_id, **kwargs):
+        names = sorted(set(
+            definition.service_name for definition in self.backend.definitions))
+        return self.backend.call("ListServices", [oci.limits.models.ServiceSummary(name=name) for name in names])
+
+    def list_limit_definitions(self, compartment_id, **kwargs):
+        return self.backend.call("ListLimitDefinitions", list(self.backend.definitions))
+
+    def list_limit_values(self, compartment_id, service_name, **kwargs):
+        values = [oci.limits.models.LimitValueSummary(name=limit_name, scope_type=scope_type, availability_domain=ad, value=value)
+                  for (service, limit_name, ad), (scope_type, value) in self.backend.values.items() if service == service_name]
+        return self.backend.call("ListLimitValues", values)
+
+    def get_resource_availability(self, service_name, limit_name, compartment_id, **kwargs):
+        used, available = self.backend.usage.get(
+            (service_name, limit_name, kwargs.get("availability_domain")), (None, None))
+        return self.backend.call("GetResourceAvailability", oci.limits.models.ResourceAvailability(used=used, available=available))
+
+
+class SimulatedIdentityClient(SimulatedClient):
+
+    def list_region_subscriptions(self, tenancy_id, **kwargs):
+        return self.backend.call("ListRegionSubscriptions", list(self.backend.regions))
+
+    def list_availability_domains(self, compartment_id, **kwargs):
+        return self.backend.call("ListAvailabilityDomains", [oci.identity.models.AvailabilityDomain(name=name, compartment_id=compartment_id)
+                                                             for name in self.backend.ads])
+
+
+class SimulatedNotificationClient(SimulatedClient):
+
+    def publish_message(self, topic_id, message_details, **kwargs):
+        with self.backend.lock:
+            self.backend.published.append(message_details)
+        return self.backend.call("PublishMessage", oci.ons.models.PublishResult(message_id=str(len(self.backend.published))))
+
+
+class SimulatedObjectStorageClient(SimulatedClient):
+
+    def get_namespace(self, **kwargs):
+        return self.backend.call("GetNamespace", self.backend.namespace)
+
+    def get_object(self, namespace_name, bucket_name, object_name, **kwargs):
+        with self.backend.lock:
+            content = self.backend.objects.get((bucket_name, object_name))
+        if content == None:
+            self.backend.call("GetObject")
+            raise oci.exceptions.ServiceError(
+                404, "ObjectNotFound", {}, "The object {} was not found".format(object_name))
+        return self.backend.call("GetObject", types.SimpleNamespace(content=content))
+
+    def list_objects(self, namespace_name, bucket_name, **kwargs):
+        prefix = kwargs.get("prefix") or ""
+        with self.backend.lock:
+            names = sorted(name for bucket, name in self.backend.objects
+                           if bucket == bucket_name and name.startswith(prefix))
+        return self.backend.call("ListObjects", oci.object_storage.models.ListObjects(
+            objects=[oci.object_storage.models.ObjectSummary(name=name) for name in names]))
+
+    def create_multipart_upload(self, namespace_name, bucket_name, create_multipart_upload_details, **kwargs):
+        upload_id = "upload-{}".format(create_multipart_upload_details.object)
+        with self.backend.lock:
+            self.backend.objects[("uploads", upload_id)] = {}
+        return self.backend.call("CreateMultipartUpload", oci.object_storage.models.MultipartUpload(upload_id=upload_id))
+
+    def upload_part(self, namespace_name, bucket_name, object_name, upload_id, upload_part_num, upload_part_body, **kwargs):
+        with self.backend.lock:
+            self.backend.objects[("uploads", upload_id)
+                                 ][upload_part_num] = upload_part_body
+        return self.backend.call("UploadPart", headers={"etag": "etag-{}".format(upload_part_num)})
+
+    def commit_multipart_upload(self, namespace_name, bucket_name, object_name, upload_id, commit_multipart_upload_details, **kwargs):
+        with self.backend.lock:
+            parts = self.backend.objects.pop(("uploads", upload_id))
+            self.backend.objects[(bucket_name, object_name)] = b"".join(
+                parts[part.part_num] for part in commit_multipart_upload_details.parts_to_commit)
+        return self.backend.call("CommitMultipartUpload")
+
+    def abort_multipart_upload(self, namespace_name, bucket_name, object_name, upload_id, **kwargs):
+        with self.backend.lock:
+            self.backend.objects.pop(("uploads", upload_id), None)
+        return self.backend.call("AbortMultipartUpload")
+
+    def put_object(self, namespace_name, bucket_name, object_name, put_object_body, **kwargs):
+        if isinstance(put_object_body, str):
+            put_object_body = put_object_body.encode()
+        with self.backend.lock:
+            self.backend.objects[(bucket_name, object_name)] = put_object_body
+        return self.backend.call("PutObject")
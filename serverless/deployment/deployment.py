@@ -1,7 +1,10 @@
+import hashlib
 import io
 import os
 import json
 import oci
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from oci import events
 from oci.config import from_file
@@ -71,6 +74,7 @@ def create_rule(comp_id, fn_prefix, fn_id, bucket_name):
         {
             "eventType": "com.oraclecloud.objectstorage.deleteobject",
             "data": {
+                "resourceName": "main.txt",
                 "additionalDetails": {
                     "bucketName": bucket_name
                 }
@@ -109,6 +113,160 @@ def get_function(fn_name):
     return fns
 
 
+def build_manifest(reports, fn_prefix):
+    """ Builds the manifest of the regional functions used by the main function
+
+    The functions come from the deployment reports rather than from listing the application,
+    so functions still in the CREATING or UPDATING state are not left out.
+
+    Parameters:
+    reports - The reports returned by deploy_function
+    fn_prefix - The prefix of the regional functions
+
+    Returns:
+    A dict with the fn_prefix and the name, id and invoke_endpoint of every regional function
+    """
+    functions = [{"name": report["function"], "id": report["id"], "invoke_endpoint": report["invoke_endpoint"]}
+                 for report in reports if report.get("id") != None]
+    return {"fn_prefix": fn_prefix, "functions": functions}
+
+
+def source_hash(directory, file_names):
+    """ Hashes the source files of a function, used as the tag of its image
+
+    Parameters:
+    directory - The directory of the function
+    file_names - The names of the files that go in the image
+
+    Returns:
+    The first 12 hex digits of the sha256 of the files
+    """
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        digest.update(file_name.encode())
+        with open(os.path.join(directory, file_name), "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:12]
+
+
+def deployment_hash(image, fn_config, memory, timeout):
+    """ Hashes everything a deployment sets on a function, so unchanged functions can be skipped
+
+    Parameters:
+    image - The image of the function
+    fn_config - The config of the function
+    memory - The memory of the function in MB
+    timeout - The timeout of the function in seconds
+
+    Returns:
+    The sha256 of the deployment
+    """
+    return hashlib.sha256(json.dumps({"image": image, "config": fn_config, "memory": memory, "timeout": timeout},
+                                     sort_keys=True).encode()).hexdigest()
+
+
+def image_exists(image):
+    """ Checks if an image was already pushed to the registry
+
+    Parameters:
+    image - The full name of the image
+
+    Returns:
+    True if the registry has the image
+    """
+    inspect = Popen("docker manifest inspect {}".format(image),
+                    stdout=PIPE, stderr=PIPE, shell=True)
+    stdout, stderr = inspect.communicate()
+    return inspect.returncode == 0
+
+
+def build_image(image, fn_prefix, tag):
+    """ Builds the image of the regional functions with the fn CLI and pushes it, once for all of the regions
+
+    Parameters:
+    image - The full name of the image
+    fn_prefix - The prefix name of the fn, used as the image name
+    tag - The tag of the image
+
+    Returns:
+    None
+    """
+    build_config = '''
+schema_version: 20180708
+name: {{ fn_prefix }}
+version: {{ tag }}
+runtime: docker
+memory: 1024
+timeout: 300'''
+    with open('./func.yaml', "w") as myfile:
+        myfile.write(Template(build_config).render(
+            fn_prefix=fn_prefix, tag=tag))
+    print("Building image {}".format(image))
+    build = Popen('fn build', stdout=PIPE, stderr=PIPE, shell=True)
+    stdout, stderr = build.communicate()
+    if build.returncode != 0:
+        raise Exception("fn build failed: {}".format(stderr.decode()))
+    push = Popen('docker push {}'.format(image),
+                 stdout=PIPE, stderr=PIPE, shell=True)
+    stdout, stderr = push.communicate()
+    if push.returncode != 0:
+        raise Exception("docker push failed: {}".format(stderr.decode()))
+
+
+def deploy_function(app_id, existing, fn_name, image, fn_config, memory=1024, timeout=300):
+    """ Creates or updates a function, unless it already runs the same image and config
+
+    Parameters:
+    app_id - The id of the application
+    existing - The function summary with the same name or None
+    fn_name - The name of the function
+    image - The image of the function
+    fn_config - The config of the function
+    memory - The memory of the function in MB
+    timeout - The timeout of the function in seconds
+
+    Returns:
+    A dict with the function name, status (created, updated, unchanged or failed), seconds and the
+    id and invoke_endpoint of the function, which are missing when it could not be created
+    """
+    start = time.monotonic()
+    report = {"function": fn_name}
+    if existing != None:
+        report["id"] = existing.id
+        report["invoke_endpoint"] = existing.invoke_endpoint
+    fn_hash = deployment_hash(image, fn_config, memory, timeout)
+    try:
+        if existing != None and (existing.freeform_tags or {}).get("deployment_hash") == fn_hash:
+            report["status"] = "unchanged"
+        elif existing != None:
+            function = fn_mgmt_client.update_function(existing.id, oci.functions.models.UpdateFunctionDetails(
+                source_details=oci.functions.models.UpdateContainerImageFunctionSourceDetails(
+                    image=image),
+                memory_in_mbs=memory, timeout_in_seconds=timeout, config=fn_config,
+                freeform_tags=dict(existing.freeform_tags or {}, deployment_hash=fn_hash))).data
+            report["id"] = function.id
+            report["invoke_endpoint"] = function.invoke_endpoint
+            report["status"] = "updated"
+        else:
+            function = fn_mgmt_client.create_function(oci.functions.models.CreateFunctionDetails(
+                display_name=fn_name, application_id=app_id,
+                source_details=oci.functions.models.CreateContainerImageFunctionSourceDetails(
+                    image=image),
+                memory_in_mbs=memory, timeout_in_seconds=timeout, config=fn_config,
+                freeform_tags={"deployment_hash": fn_hash})).data
+            report["id"] = function.id
+            report["invoke_endpoint"] = function.invoke_endpoint
+            report["status"] = "created"
+    except Exception as e:
+        print(e)
+        report["status"] = "failed"
+        report["error"] = str(e)
+    report["seconds"] = round(time.monotonic() - start, 3)
+    print("Function {} {} in {}s".format(
+        fn_name, report["status"], report["seconds"]))
+    return report
+
+
 def put_object(namespace_name, bucket_name, object_name, put_object_body):
     """ Adds an object to object storage
 
@@ -154,6 +312,18 @@ if __name__ == "__main__":
     parser.add_argument("-fn_prefix", dest="fn_prefix", type=str, required=True,
                         help="The prefix name of the fn \n")
 
+    parser.add_argument("-mode", dest="mode", type=str, required=False, default="regional", choices=["regional", "single"],
+                        help="regional deploys one fn per subscribed region, single deploys one fn that checks all of the regions in parallel \n")
+
+    parser.add_argument("-region_concurrency", dest="region_concurrency", type=str, required=False, default="8",
+                        help="The number of regions checked in parallel by the fn deployed in single mode \n")
+
+    parser.add_argument("-concurrency", dest="concurrency", type=str, required=False, default="8",
+                        help="The number of limit checks that each regional fn runs in parallel \n")
+
+    parser.add_argument("-deploy_concurrency", dest="deploy_concurrency", type=str, required=False, default="8",
+                        help="The number of functions created or updated in parallel \n")
+
     args = parser.parse_args()
 
     config, identity_client, fn_mgmt_client, os_client, events_client, search_client = initialize()
@@ -201,8 +371,7 @@ if __name__ == "__main__":
 schema_version: 20180708
 name: main_{{ fn_prefix }}
 version: 0.0.1
-runtime: python
-entrypoint: /python/bin/fdk /function/func.py handler
+runtime: docker
 memory: 256
 timeout: 300
 config:
@@ -221,31 +390,53 @@ config:
         'fn deploy --app {}'.format(args.app_name), stdout=PIPE, stderr=PIPE, shell=True)
     stdout, stderr = add_main_to_app.communicate()
 
-    fn_config = '''
-schema_version: 20180708
-name: {{ fn_prefix }}_{{ region_key }}
-version: 0.0.1
-runtime: python
-entrypoint: /python/bin/fdk /function/func.py handler
-memory: 1024
-timeout: 300
-config:
-  regions: {{ region_name }}
-  percentage: {{ percentage }}
-  topic_id: {{ topic_id }}'''
-
     os.chdir("../fn")
-    tm = Template(fn_config)
-
-    for reg in regions.data:
-        msg = tm.render(fn_prefix=args.fn_prefix, region_key=str(reg.region_key).lower(
-        ), region_name=reg.region_name, percentage=args.percentage, topic_id=args.topic_id)
-        with open('./func.yaml', "w") as myfile:
-            myfile.write(msg)
-        print("Publishing function for region {}".format(reg.region_name))
-        add_func_to_app = Popen(
-            'fn deploy --app {}'.format(args.app_name), stdout=PIPE, stderr=PIPE, shell=True)
-        stdout, stderr = add_func_to_app.communicate()
+    deploy_start = time.monotonic()
+    tag = source_hash(".", ["func.py", "requirements.txt", "Dockerfile"])
+    image = "{}.ocir.io/{}/limits/{}:{}".format(
+        home_region_key, tenancy_namespace, args.fn_prefix, tag)
+    if image_exists(image):
+        print("Image {} already pushed".format(image))
+    else:
+        build_image(image, args.fn_prefix, tag)
+
+    if args.mode == "single":
+        deployments = [("all", None)]
+    else:
+        deployments = [(str(reg.region_key).lower(), reg.region_name)
+                       for reg in regions.data]
+
+    app_id = oci.pagination.list_call_get_all_results(
+        fn_mgmt_client.list_applications, args.compartment_id, display_name=args.app_name).data[0].id
+    existing = {fn.display_name: fn for fn in oci.pagination.list_call_get_all_results(
+        fn_mgmt_client.list_functions, app_id).data if fn.lifecycle_state not in ["DELETING", "DELETED"]}
+
+    def deploy(deployment):
+        region_key, region_name = deployment
+        fn_name = "{}_{}".format(args.fn_prefix, region_key)
+        fn_config = {"percentage": args.percentage, "topic_id": args.topic_id,
+                     "concurrency": args.concurrency, "bucket_name": args.bucket_name}
+        if region_name:
+            fn_config["regions"] = region_name
+            fn_config["global_region"] = home_region_name
+        else:
+            fn_config["region_concurrency"] = args.region_concurrency
+        report = deploy_function(app_id, existing.get(
+            fn_name), fn_name, image, fn_config)
+        report["region"] = region_name or "all"
+        return report
+
+    with ThreadPoolExecutor(max_workers=max(1, min(int(args.deploy_concurrency), len(deployments)))) as executor:
+        reports = list(executor.map(deploy, deployments))
+    print(json.dumps({"image": image, "seconds": round(time.monotonic() - deploy_start, 3),
+                      "functions": reports}, indent=2))
+
+    try:
+        manifest = build_manifest(reports, "{}_".format(args.fn_prefix))
+        put_object(tenancy_namespace, args.bucket_name,
+                   "fn_manifest.json", json.dumps(manifest))
+    except Exception as e:
+        print(e)
 
     fn_details = get_function("main_{}".format(args.fn_prefix))
     create_rule(comp_id=args.compartment_id, fn_prefix=args.fn_prefix, fn_id=fn_details.items[0].identifier,
@@ -1,13 +1,20 @@
+import argparse
+import asyncio
+import csv
+import fnmatch
 import io
 import json
 import logging
 import oci
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-from oci.identity.models import region
 import backoff
-import logging
 import os
+import re
+import threading
+import time
+import zlib
 
 from fdk import response
 
@@ -19,6 +26,587 @@ identity_client = None
 notifications_client = None
 os_client = None
 
+signer = None
+default_config = {}
+clients = {}
+clients_lock = threading.Lock()
+region_subscriptions = None
+region_cache_ttl = 3600
+
+# The client classes are looked up when the first client is created, the oci package only
+# imports a service package on its first access
+CLIENT_CLASSES = {
+    "limits": lambda config, **kwargs: oci.limits.LimitsClient(config, **kwargs),
+    "quotas": lambda config, **kwargs: oci.limits.QuotasClient(config, **kwargs),
+    "search": lambda config, **kwargs: oci.resource_search.ResourceSearchClient(config, **kwargs),
+    "identity": lambda config, **kwargs: oci.identity.IdentityClient(config, **kwargs),
+    "notifications": lambda config, **kwargs: oci.ons.NotificationDataPlaneClient(config, **kwargs),
+    "object_storage": lambda config, **kwargs: oci.object_storage.ObjectStorageClient(config, **kwargs)
+}
+
+
+class AdaptiveRateLimiter(object):
+    """ Token bucket of the Limits API calls made to one regional endpoint
+
+    Calls are not delayed until one is throttled (429). The first throttle sets the rate
+    to half of the rate observed over the last second and every following one halves it
+    again, at most once per second so the calls throttled in the same burst count once.
+    After increase_after consecutive successful calls the rate is raised by a tenth, at
+    least by increase_step.
+    """
+
+    def __init__(self, rate=None, min_rate=1.0, max_rate=None, increase_step=1.0, increase_after=20):
+        self.lock = threading.Lock()
+        self.min_rate = float(min_rate)
+        self.configure(rate, max_rate)
+        self.increase_step = increase_step
+        self.increase_after = increase_after
+        self.reset_counters()
+
+    def configure(self, rate, max_rate=None):
+        """ Sets the rate and the highest rate in calls per second, None for no limit """
+        with self.lock:
+            self.max_rate = None if max_rate == None else float(max_rate)
+            if rate == None:
+                rate = self.max_rate
+            if rate != None:
+                rate = max(float(rate), self.min_rate)
+                if self.max_rate != None:
+                    rate = min(rate, self.max_rate)
+            self.rate = rate
+            self.tokens = rate or 0
+            self.updated = time.monotonic()
+            self.window_start = self.updated
+            self.window_calls = 0
+            self.observed_rate = 0.0
+            self.decreased = None
+            self.consecutive_successes = 0
+
+    def reset_counters(self):
+        """ Resets the call counters, the learned rate is kept """
+        with self.lock:
+            self.successful = 0
+            self.throttled = 0
+            self.failed = 0
+            self.waited = 0.0
+
+    def acquire(self):
+        """ Blocks until a call is allowed by the bucket """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate == None:
+                if now - self.window_start >= 1:
+                    self.observed_rate = self.window_calls / \
+                        (now - self.window_start)
+                    self.window_start = now
+                    self.window_calls = 0
+                self.window_calls += 1
+                return
+            self.tokens = min(self.rate, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.successful += 1
+            if self.rate == None:
+                return
+            self.consecutive_successes += 1
+            if self.consecutive_successes >= self.increase_after:
+                self.rate += max(self.increase_step, self.rate / 10)
+                if self.max_rate != None:
+                    self.rate = min(self.max_rate, self.rate)
+                self.consecutive_successes = 0
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttled += 1
+            self.consecutive_successes = 0
+            now = time.monotonic()
+            if self.decreased != None and now - self.decreased < 1:
+                return
+            self.decreased = now
+            if self.rate == None:
+                self.rate = max(self.observed_rate, self.window_calls /
+                                max(now - self.window_start, 0.1))
+                self.updated = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def on_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def stats(self):
+        """ Returns the limiter counters as a dict """
+        with self.lock:
+            return {
+                "rate": None if self.rate == None else round(self.rate, 2),
+                "successful": self.successful,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "waited_seconds": round(self.waited, 3)
+            }
+
+
+class RegionRateLimiters(object):
+    """ One AdaptiveRateLimiter per service and region, OCI throttles every regional endpoint on its own
+
+    rate and max_rate only apply to the Limits API, the limiters of the other services
+    start without a limit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters = {}
+        self.rate = None
+        self.max_rate = None
+
+    def configure(self, rate, max_rate=None):
+        """ Sets the starting rate and the highest rate of the Limits API in every region, None for no limit """
+        with self.lock:
+            self.rate = rate
+            self.max_rate = max_rate
+            limiters = [limiter for (service, region), limiter in self.limiters.items()
+                        if service == "limits"]
+        for limiter in limiters:
+            limiter.configure(rate, max_rate)
+
+    def get(self, region, service="limits"):
+        """ Returns the limiter of a service in a region, created on first use """
+        with self.lock:
+            limiter = self.limiters.get((service, region))
+            if limiter == None:
+                if service == "limits":
+                    limiter = AdaptiveRateLimiter(
+                        self.rate, max_rate=self.max_rate)
+                else:
+                    limiter = AdaptiveRateLimiter()
+                self.limiters[(service, region)] = limiter
+            return limiter
+
+    def reset_counters(self):
+        """ Resets the call counters of every region, the learned rates are kept """
+        with self.lock:
+            limiters = list(self.limiters.values())
+        for limiter in limiters:
+            limiter.reset_counters()
+
+    def stats(self, service="limits"):
+        """ Returns the counters of a service summed over the regions and the stats of every region """
+        with self.lock:
+            regions = {region: limiter.stats()
+                       for (limiter_service, region), limiter in self.limiters.items() if limiter_service == service}
+        result = {name: sum(region[name] for region in regions.values())
+                  for name in ["successful", "throttled", "failed"]}
+        result["waited_seconds"] = round(
+            sum(region["waited_seconds"] for region in regions.values()), 3)
+        result["regions"] = regions
+        return result
+
+
+rate_limiter = RegionRateLimiters()
+
+
+class CallMetrics(object):
+    """ Counters and latency histograms of the OCI calls, per operation and region """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def entry(self, operation, region):
+        key = (operation, region)
+        entry = self.operations.get(key)
+        if entry == None:
+            entry = {"count": 0, "errors": 0, "throttled": 0, "retries": 0, "bytes": 0,
+                     "seconds": 0.0, "max_seconds": 0.0, "histogram": [0] * (len(self.BUCKETS) + 1)}
+            self.operations[key] = entry
+        return entry
+
+    def record(self, operation, region, seconds, status=200, size=0):
+        """ Records a single call """
+        bucket = len(self.BUCKETS)
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                bucket = index
+                break
+        with self.lock:
+            entry = self.entry(operation, region)
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["bytes"] += size
+            entry["histogram"][bucket] += 1
+            if status == 429:
+                entry["throttled"] += 1
+            elif status >= 400:
+                entry["errors"] += 1
+
+    def record_retry(self, operation, region):
+        """ Records that a failed call is retried by backoff """
+        with self.lock:
+            self.entry(operation, region)["retries"] += 1
+
+    def stats(self):
+        """ Returns the counters as a list of dicts, one per operation and region """
+        with self.lock:
+            operations = []
+            for (operation, region), entry in sorted(self.operations.items()):
+                operations.append(dict(entry, operation=operation, region=region, seconds=round(entry["seconds"], 3),
+                                       max_seconds=round(entry["max_seconds"], 3), histogram=list(entry["histogram"])))
+            return {"histogram_buckets": list(self.BUCKETS), "operations": operations}
+
+
+call_metrics = CallMetrics()
+
+
+class HTTPPool(object):
+    """ One sized HTTPS connection pool shared by every OCI client of the function
+
+    The clients of a warm function keep their connections between regions, calls and
+    invocations. Every new HTTPS connection is counted as a TLS handshake and the time
+    spent waiting for a free connection of a full pool is measured.
+    """
+
+    def __init__(self, maxsize=10, hosts=64):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.hosts = hosts
+        self.adapter = None
+        self.reset()
+
+    def configure(self, maxsize, hosts=None):
+        """ Sizes the pool, a new adapter is only built when the size changes """
+        with self.lock:
+            if self.adapter != None and maxsize == self.maxsize and (hosts == None or hosts == self.hosts):
+                return
+            self.maxsize = maxsize
+            if hosts != None:
+                self.hosts = hosts
+            self.adapter = None
+        for client in list(clients.values()):
+            self.mount(client)
+
+    def reset(self):
+        with self.lock:
+            self.handshakes = 0
+            self.checkouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def get_adapter(self):
+        with self.lock:
+            if self.adapter == None:
+                self.adapter = self.create_adapter()
+            return self.adapter
+
+    def create_adapter(self):
+        pool = self
+        adapter_class = getattr(oci.base_client, "OCIHTTPAdapter",
+                                oci.base_client.requests.adapters.HTTPAdapter)
+
+        class PooledAdapter(adapter_class):
+
+            def init_poolmanager(self, *args, **kwargs):
+                super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {scheme: pool.instrument(pool_class)
+                                                           for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()}
+
+        return PooledAdapter(pool_connections=self.hosts, pool_maxsize=self.maxsize, pool_block=True)
+
+    def instrument(self, pool_class):
+        pool = self
+
+        class InstrumentedPool(pool_class):
+
+            def _new_conn(self):
+                with pool.lock:
+                    pool.handshakes += 1
+                return super(InstrumentedPool, self)._new_conn()
+
+            def _get_conn(self, timeout=None):
+                start = time.perf_counter()
+                conn = super(InstrumentedPool, self)._get_conn(timeout)
+                waited = time.perf_counter() - start
+                with pool.lock:
+                    pool.checkouts += 1
+                    pool.wait_seconds += waited
+                    pool.max_wait_seconds = max(pool.max_wait_seconds, waited)
+                return conn
+
+        return InstrumentedPool
+
+    def mount(self, client):
+        """ Points the HTTPS requests of an OCI client to the shared pool """
+        base_client = getattr(client, "base_client", None)
+        if base_client != None:
+            base_client.session.mount("https://", self.get_adapter())
+
+    def stats(self):
+        with self.lock:
+            return {"maxsize": self.maxsize, "tls_handshakes": self.handshakes, "checkouts": self.checkouts,
+                    "pool_wait_seconds": round(self.wait_seconds, 3), "max_pool_wait_seconds": round(self.max_wait_seconds, 3)}
+
+
+http_pool = HTTPPool()
+
+
+class ResultWriter(object):
+    """ Writes one NDJSON record per evaluated limit as soon as it is evaluated
+
+    Records are kept for the response when keep_lines is True and uploaded to object storage
+    in parts of part_size bytes when object_name is set, so a run that only writes to the
+    bucket keeps a flat memory footprint.
+    """
+
+    def __init__(self, keep_lines=True, bucket_name=None, object_name=None, part_size=10 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.keep_lines = keep_lines
+        self.lines = []
+        self.namespace = None
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.part_size = part_size
+        self.buffer = io.BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, record):
+        """ Writes a record """
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self.lock:
+            self.records += 1
+            self.bytes += len(line)
+            if self.keep_lines:
+                self.lines.append(line)
+            if self.object_name != None:
+                self.buffer.write(line.encode())
+                if self.buffer.tell() >= self.part_size:
+                    self.upload_part()
+
+    def upload_part(self):
+        """ Uploads the buffered records as the next part of the multipart upload """
+        if self.upload_id == None:
+            self.upload_id = api_call(os_client.create_multipart_upload, rate_limited=False)(
+                self.namespace, self.bucket_name, oci.object_storage.models.CreateMultipartUploadDetails(
+                    object=self.object_name, content_type="application/x-ndjson")).data.upload_id
+        part_num = len(self.parts) + 1
+        etag = put_object_part(self.namespace, self.bucket_name, self.object_name,
+                               self.upload_id, part_num, self.buffer.getvalue())
+        self.parts.append(oci.object_storage.models.CommitMultipartUploadPartDetails(
+            part_num=part_num, etag=etag))
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        """ Uploads the remaining records and commits the object """
+        if self.object_name == None:
+            return
+        with self.lock:
+            try:
+                if self.upload_id == None:
+                    put_object(self.namespace, self.bucket_name,
+                               self.object_name, self.buffer.getvalue())
+                    return
+                if self.buffer.tell() > 0:
+                    self.upload_part()
+                commit_object_parts(self.namespace, self.bucket_name,
+                                    self.object_name, self.upload_id, self.parts)
+            except Exception:
+                if self.upload_id != None:
+                    api_call(os_client.abort_multipart_upload, rate_limited=False)(
+                        self.namespace, self.bucket_name, self.object_name, self.upload_id)
+                raise
+
+    def getvalue(self):
+        """ Returns the kept records as NDJSON """
+        with self.lock:
+            return "".join(self.lines)
+
+    def stats(self):
+        return {"records": self.records, "bytes": self.bytes, "object_name": self.object_name, "parts": len(self.parts)}
+
+
+call_context = threading.local()
+client_regions = {}
+
+
+class LimitFilter(object):
+    """ Selects the limit definitions to check by service name, limit name and scope
+
+    Patterns are comma separated globs, or regular expressions when prefixed with re:.
+    Every list is compiled once into a single regular expression, an empty include list
+    matches everything.
+    """
+
+    def __init__(self, services=None, exclude_services=None, limits=None, exclude_limits=None, scopes=None):
+        self.services = self.compile(services)
+        self.exclude_services = self.compile(exclude_services)
+        self.limits = self.compile(limits)
+        self.exclude_limits = self.compile(exclude_limits)
+        self.scopes = set(scope.upper() for scope in self.split(scopes))
+
+    @staticmethod
+    def split(patterns):
+        if patterns == None:
+            return []
+        if isinstance(patterns, str):
+            patterns = patterns.split(',')
+        return [pattern.strip() for pattern in patterns if pattern.strip()]
+
+    @classmethod
+    def compile(cls, patterns):
+        expressions = []
+        for pattern in cls.split(patterns):
+            if pattern.startswith("re:"):
+                expressions.append("(?:{})$".format(pattern[3:]))
+            else:
+                expressions.append(fnmatch.translate(pattern))
+        if len(expressions) == 0:
+            return None
+        return re.compile("|".join(expressions))
+
+    def is_empty(self):
+        return self.services == None and self.exclude_services == None and self.limits == None and \
+            self.exclude_limits == None and len(self.scopes) == 0
+
+    def service_matches(self, service_name):
+        """ Returns True when the limits of the service have to be checked """
+        return (self.services == None or self.services.match(service_name) != None) and \
+            (self.exclude_services == None or self.exclude_services.match(service_name) == None)
+
+    def limit_matches(self, limit):
+        """ Returns True when the scope and the name of the limit definition have to be checked """
+        return (len(self.scopes) == 0 or limit.scope_type in self.scopes) and \
+            (self.limits == None or self.limits.match(limit.name) != None) and \
+            (self.exclude_limits == None or self.exclude_limits.match(limit.name) == None)
+
+    def apply(self, limits):
+        """ Returns the limit definitions that have to be checked, matching every service name once """
+        if self.is_empty():
+            return limits
+        services = {}
+        selected = []
+        for limit in limits:
+            if limit.service_name not in services:
+                services[limit.service_name] = self.service_matches(
+                    limit.service_name)
+            if services[limit.service_name] and self.limit_matches(limit):
+                selected.append(limit)
+        return selected
+
+
+class ThresholdPolicies(object):
+    """ Per service and per limit alert thresholds
+
+    The rules are checked in order and the first one whose service and limit globs match
+    is used, limits without a matching rule use the default percentage. A rule can set
+    percentage, min_available (alert when fewer resources are left, whatever the percentage)
+    and min_limit (never alert for limits whose used + available is smaller). The rule of
+    every (service, limit) pair is resolved once and kept in a dict.
+    """
+
+    def __init__(self, rules=None, percentage=0):
+        self.percentage = percentage
+        self.rules = []
+        for rule in rules or []:
+            self.rules.append((LimitFilter.compile(rule.get("service", "*")), LimitFilter.compile(rule.get("limit", "*")),
+                               (float(rule.get("percentage", percentage)), int(rule.get("min_available", 0)), int(rule.get("min_limit", 0)))))
+        self.default = (float(percentage), 0, 0)
+        self.cache = {}
+
+    def lookup(self, service_name, limit_name):
+        """ Returns the (percentage, min_available, min_limit) policy of a limit """
+        policy = self.cache.get((service_name, limit_name))
+        if policy == None:
+            policy = self.default
+            for service, limit, rule_policy in self.rules:
+                if service.match(service_name) and limit.match(limit_name):
+                    policy = rule_policy
+                    break
+            self.cache[(service_name, limit_name)] = policy
+        return policy
+
+    def is_breached(self, service_name, limit_name, used, available):
+        """ Returns True when the usage of a limit is over its policy """
+        percentage, min_available, min_limit = self.lookup(
+            service_name, limit_name)
+        if used + available < min_limit or used + available == 0:
+            return False
+        return int(available * 100 / (used + available)) < percentage or available < min_available
+
+
+policy_cache = {}
+
+
+def load_policies(source, percentage):
+    """ Compiles the threshold policies of the config, once per warm function
+
+    Parameters:
+    source: The threshold_policies config, a JSON list of rules, or None
+    percentage: The default threshold
+
+    Returns:
+    A ThresholdPolicies
+    """
+    key = (source, percentage)
+    if key not in policy_cache:
+        policy_cache.clear()
+        policy_cache[key] = ThresholdPolicies(
+            json.loads(source) if source else [], percentage)
+    return policy_cache[key]
+
+
+ad_cache = {}
+ad_cache_stats = {"hits": 0, "misses": 0}
+ad_cache_lock = threading.Lock()
+
+stats_lock = threading.Lock()
+run_deadline = None
+run_end = None
+DEADLINE_REACHED = object()
+plan_stats = {
+    "limit_value_calls": 0,
+    "availability_calls": 0,
+    "skipped_unsupported": 0,
+    "skipped_zero": 0,
+    "skipped_global": 0
+}
+scan_stats = {
+    "scanned": 0,
+    "skipped_cold": 0,
+    "deadline_skipped": 0,
+    "evaluated": 0,
+    "forecast_alerts": 0,
+    "estimated_saved_seconds": 0.0
+}
+notification_stats = {
+    "messages": 0,
+    "alerts": 0,
+    "bytes": 0,
+    "max_bytes": 0
+}
+alert_stats = {
+    "new": 0,
+    "worsened": 0,
+    "resolved": 0,
+    "suppressed": 0,
+    "digests": 0
+}
+
 
 def create_log():
     """ Creates logging file
@@ -49,8 +637,95 @@ def create_log():
     return logger
 
 
+def get_signer():
+    """ Gets the resource principal signer, creating it only on the first call of a container
+
+    Parameters: None
+
+    Returns: The resource principal signer
+    """
+    global signer
+    with clients_lock:
+        if signer == None:
+            signer = oci.auth.signers.get_resource_principals_signer()
+    return signer
+
+
+def use_config_file(file_location=oci.config.DEFAULT_LOCATION, profile_name=oci.config.DEFAULT_PROFILE):
+    """ Makes the clients authenticate with an OCI config file instead of the resource principal
+
+    Parameters:
+    file_location - The path of the OCI config file
+    profile_name - The profile of the OCI config file
+
+    Returns: The signer built from the config file
+    """
+    global signer
+    config = oci.config.from_file(file_location, profile_name)
+    config_signer = oci.signer.Signer(
+        tenancy=config["tenancy"],
+        user=config["user"],
+        fingerprint=config["fingerprint"],
+        private_key_file_location=config.get("key_file"),
+        pass_phrase=config.get("pass_phrase"),
+        private_key_content=config.get("key_content")
+    )
+    config_signer.tenancy_id = config["tenancy"]
+    with clients_lock:
+        signer = config_signer
+        default_config["region"] = config["region"]
+        clients.clear()
+    return signer
+
+
+def get_client(service, region=None):
+    """ Gets an OCI client from the registry, creating it only the first time it is needed
+
+    Parameters:
+    service - One of the keys of CLIENT_CLASSES
+    region - The region of the client. None uses the region of the signer
+
+    Returns:
+    The client for the service and region
+    """
+    key = (service, region)
+    client = clients.get(key)
+    if client == None:
+        client_signer = get_signer()
+        with clients_lock:
+            client = clients.get(key)
+            if client == None:
+                config = dict(default_config)
+                if region != None:
+                    config["region"] = region
+                client = CLIENT_CLASSES[service](config, signer=client_signer)
+                http_pool.mount(client)
+                clients[key] = client
+                client_regions[id(client)] = config.get(
+                    "region", getattr(client_signer, "region", "default"))
+    return client
+
+
+def get_region_subscriptions(tenancy_id):
+    """ Lists the region subscriptions of the tenancy, reusing the last result for region_cache_ttl seconds
+
+    Parameters:
+    tenancy_id - The id of the tenancy
+
+    Returns:
+    The region subscriptions
+    """
+    global region_subscriptions
+    now = time.monotonic()
+    if region_subscriptions == None or now - region_subscriptions[0] >= region_cache_ttl:
+        data = api_call(get_client("identity").list_region_subscriptions, rate_limited=False)(
+            tenancy_id).data
+        region_subscriptions = (now, data)
+    return region_subscriptions[1]
+
+
 def initialize(region=None):
-    """Creates OCI python sdk clients
+    """Gets the OCI python sdk clients from the client registry
 
     Parameters:
     region - the region in which you want to spawn the config
@@ -69,7 +744,7 @@ def initialize(region=None):
     os_client - Client used for making object storage requests
     """
 
-    signer = oci.auth.signers.get_resource_principals_signer()
+    signer = get_signer()
 
     global limits_client
     global quotas_client
@@ -77,33 +752,36 @@ def initialize(region=None):
     global identity_client
     global notifications_client
     global os_client
-    identity_client = oci.identity.IdentityClient({}, signer=signer)
-    response = identity_client.list_region_subscriptions(signer.tenancy_id)
-    for reg in response.data:
+    for reg in get_region_subscriptions(signer.tenancy_id):
         if reg.is_home_region:
-            quotas_client = oci.limits.QuotasClient(
-                config={"region": reg.region_name}, signer=signer)
-            notifications_client = oci.ons.NotificationDataPlaneClient(
-                config={"region": reg.region_name}, signer=signer)
-            os_client = oci.object_storage.ObjectStorageClient(
-                config={"region": reg.region_name}, signer=signer)
+            quotas_client = get_client("quotas", reg.region_name)
+            notifications_client = get_client("notifications", reg.region_name)
+            os_client = get_client("object_storage", reg.region_name)
             break
 
-    if region != None:
-        limits_client = oci.limits.LimitsClient(
-            config={"region": region}, signer=signer)
-        search_client = oci.resource_search.ResourceSearchClient(
-            config={"region": region}, signer=signer)
-        identity_client = oci.identity.IdentityClient(
-            config={"region": region}, signer=signer)
-    else:
-        limits_client = oci.limits.LimitsClient({}, signer=signer)
-        search_client = oci.resource_search.ResourceSearchClient(
-            {}, signer=signer)
-        identity_client = oci.identity.IdentityClient({}, signer=signer)
+    limits_client = get_client("limits", region)
+    search_client = get_client("search", region)
+    identity_client = get_client("identity", region)
     return signer, limits_client, quotas_client, search_client, identity_client, notifications_client, os_client
 
 
+def regional_client(service, region=None):
+    """ Gets the client of a region, so regions can be scanned in parallel without initialize
+
+    Parameters:
+    service - "limits" or "identity"
+    region - The region of the client. None returns the client set by the last initialize call
+
+    Returns:
+    The client for the service and region
+    """
+    if region == None:
+        if service == "limits":
+            return limits_client
+        return identity_client
+    return get_client(service, region)
+
+
 def is_throttling_error(err):
     """ Returns a bool depending if the status of the error is 429 or not
 
@@ -119,7 +797,87 @@ def is_throttling_error(err):
     return True
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
+def api_call(method, rate_limited=True, service="limits"):
+    """ Wraps an OCI client method so every call is measured and goes through the rate limiter of its service and region
+
+    Parameters:
+    method: The client method, for example limits_client.get_resource_availability
+    rate_limited: False for the calls that are only measured
+    service: The service whose limiter is used, limits or ons
+
+    Returns:
+    A callable with the same signature as method
+    """
+    operation = method.__name__
+    region = client_regions.get(id(getattr(method, "__self__", None)), "default")
+    if rate_limited:
+        limiter = rate_limiter.get(region, service)
+
+    def call(*args, **kwargs):
+        if rate_limited:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            result = method(*args, **kwargs)
+        except oci.exceptions.ServiceError as e:
+            call_metrics.record(operation, region,
+                                time.monotonic() - start, e.status)
+            call_context.failed = (operation, region)
+            if rate_limited:
+                if e.status == 429:
+                    limiter.on_throttle()
+                else:
+                    limiter.on_failure()
+            raise
+        headers = getattr(result, "headers", None) or {}
+        call_metrics.record(operation, region, time.monotonic() - start,
+                            getattr(result, "status", 200), int(headers.get("content-length", 0) or 0))
+        if rate_limited:
+            limiter.on_success()
+        return result
+    return call
+
+
+def backoff_max_time():
+    """ How long backoff keeps retrying the scan calls, never past the deadline of the run
+
+    Parameters: None
+
+    Returns: The number of seconds
+    """
+    if run_deadline == None:
+        return 300
+    return min(300, max(0, run_deadline - time.monotonic()))
+
+
+def save_backoff_max_time():
+    """ How long backoff keeps retrying the calls that publish and save the results, which
+    run in the deadline margin, never past the end of the run
+
+    Parameters: None
+
+    Returns: The number of seconds
+    """
+    if run_end == None:
+        return 300
+    return min(300, max(0, run_end - time.monotonic()))
+
+
+def record_backoff(details):
+    """ backoff handler that counts the retry against the call that failed last in this thread
+
+    Parameters:
+    details: The backoff details
+
+    Returns:
+    None
+    """
+    failed = getattr(call_context, "failed", None)
+    if failed != None:
+        call_metrics.record_retry(*failed)
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
 def get_compartment(comp_name):
     """ Gets compartment
 
@@ -133,11 +891,12 @@ def get_compartment(comp_name):
     structured_search = oci.resource_search.models.StructuredSearchDetails(query="query compartment resources where displayName='{}'".format(comp_name),
                                                                            type='Structured',
                                                                            matching_context_type=oci.resource_search.models.SearchDetails.MATCHING_CONTEXT_TYPE_NONE)
-    comps = search_client.search_resources(structured_search).data
+    comps = api_call(search_client.search_resources,
+                     rate_limited=False)(structured_search).data
     return comps
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
 def get_topic(topic_name):
     """ Gets topic
 
@@ -151,11 +910,12 @@ def get_topic(topic_name):
     structured_search = oci.resource_search.models.StructuredSearchDetails(query="query onstopic resources where displayName='{}'".format(topic_name),
                                                                            type='Structured',
                                                                            matching_context_type=oci.resource_search.models.SearchDetails.MATCHING_CONTEXT_TYPE_NONE)
-    topics = search_client.search_resources(structured_search).data
+    topics = api_call(search_client.search_resources,
+                      rate_limited=False)(structured_search).data
     return topics
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
 def list_quotas(compartment_id):
     """ Lists quotas
 
@@ -167,71 +927,131 @@ def list_quotas(compartment_id):
     """
     logger.info(
         "[INFO] Getting quotas for compartment: {}".format(compartment_id))
-    return quotas_client.list_quotas(compartment_id=compartment_id).data
+    return api_call(quotas_client.list_quotas, rate_limited=False)(compartment_id=compartment_id).data
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
-def list_services(tenancy_id):
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def list_services(tenancy_id, region=None):
     """ Lists Services
 
     Parameters:
     tenancy_id: The id of the tenancy
+    region: The region of the limits client. None uses the client set by initialize
 
     Returns:
     Services for a specific compartment
     """
     logger.info("[INFO] Getting services for tenancy: {}".format(tenancy_id))
-    return limits_client.list_services(compartment_id=tenancy_id).data
+    return api_call(regional_client("limits", region).list_services)(compartment_id=tenancy_id).data
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
-def list_limit_values(tenancy_id, service_name):
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def list_limit_values(tenancy_id, service_name, region=None):
     """ Lists limit values
 
     Parameters:
     tenancy_id: The id of the tenancy that should be used for listing quotas
     service_name: The name of the service
+    region: The region of the limits client. None uses the client set by initialize
 
     Returns:
     Limits for a specific service
     """
     logger.info("[INFO] Getting limits for tenancy: {}".format(tenancy_id))
-    return oci.pagination.list_call_get_all_results(limits_client.list_limit_values, compartment_id=tenancy_id, service_name=service_name).data
+    return oci.pagination.list_call_get_all_results(api_call(regional_client("limits", region).list_limit_values), compartment_id=tenancy_id, service_name=service_name).data
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
-def get_resource_availability(tenancy_id, service_name, limit_name, ad=None):
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def get_resource_availability(tenancy_id, service_name, limit_name, ad=None, region=None):
     """ Lists quotas
 
     Parameters:
     tenancy_id: The id of the tenancy that should be used for listing quotas
+    region: The region of the limits client. None uses the client set by initialize
 
     Returns:
     Limits for a specific service
     """
     # logger.info("[INFO] Getting percentage for tenancy: {}".format(tenancy_id))
+    client = regional_client("limits", region)
     if ad != None:
-        return limits_client.get_resource_availability(compartment_id=tenancy_id, service_name=service_name, limit_name=limit_name, availability_domain=ad).data
+        return api_call(client.get_resource_availability)(compartment_id=tenancy_id, service_name=service_name, limit_name=limit_name, availability_domain=ad).data
     else:
-        return limits_client.get_resource_availability(compartment_id=tenancy_id, service_name=service_name, limit_name=limit_name).data
+        return api_call(client.get_resource_availability)(compartment_id=tenancy_id, service_name=service_name, limit_name=limit_name).data
 
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
-def list_limit_definition(tenancy_id):
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def list_limit_definition(tenancy_id, region=None):
     """ Lists Limit definitions
 
     Parameters:
     tenancy_id: The id of the tenancy
+    region: The region of the limits client. None uses the client set by initialize
 
     Returns:
     Limit definitions for a specific compartment
     """
     logger.info(
         "[INFO] Getting limit definitions for tenancy: {}".format(tenancy_id))
-    return oci.pagination.list_call_get_all_results(limits_client.list_limit_definitions, compartment_id=tenancy_id).data
+    return oci.pagination.list_call_get_all_results(api_call(regional_client("limits", region).list_limit_definitions), compartment_id=tenancy_id).data
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def list_availability_domains(tenancy_id, region=None):
+    """ Lists availability domains
+
+    Parameters:
+    tenancy_id: The id of the tenancy
+    region: The region of the identity client. None uses the client set by initialize
+
+    Returns:
+    The availability domains of the region
+    """
+    logger.info(
+        "[INFO] Getting availability domains for tenancy: {}".format(tenancy_id))
+    return api_call(regional_client("identity", region).list_availability_domains, rate_limited=False)(tenancy_id).data
+
 
+def expire_ad_cache(ttl=0):
+    """ Drops the cached availability domains older than ttl and resets the hit/miss counters
+
+    Parameters:
+    ttl: How many seconds cached availability domains stay valid across warm invocations. 0 keeps them for a single invocation
+
+    Returns:
+    None
+    """
+    now = time.monotonic()
+    with ad_cache_lock:
+        for region in [region for region, entry in ad_cache.items() if now - entry[0] >= ttl]:
+            del ad_cache[region]
+        ad_cache_stats["hits"] = 0
+        ad_cache_stats["misses"] = 0
+
+
+def get_availability_domains(tenancy_id, region):
+    """ Gets the availability domain names of a region, listing them only on a cache miss
+
+    Parameters:
+    tenancy_id: The id of the tenancy
+    region: The region of the availability domains
 
-@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=300, giveup=is_throttling_error)
+    Returns:
+    A list of availability domain names
+    """
+    with ad_cache_lock:
+        entry = ad_cache.get(region)
+        if entry != None:
+            ad_cache_stats["hits"] += 1
+            return entry[1]
+        ad_cache_stats["misses"] += 1
+    ads = [ad.name for ad in list_availability_domains(tenancy_id, region)]
+    with ad_cache_lock:
+        ad_cache[region] = (time.monotonic(), ads)
+    return ads
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=save_backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
 def publish_message(topic_id, body, title):
     """ Publishes message to a topic
 
@@ -244,108 +1064,1201 @@ def publish_message(topic_id, body, title):
     None
     """
     logger.info("[INFO] Publishing alert to topic.")
-    notifications_client.publish_message(topic_id, oci.ons.models.MessageDetails(
+    api_call(notifications_client.publish_message, service="ons")(topic_id, oci.ons.models.MessageDetails(
         body=body,
         title=title
     ))
 
 
-def check_limits(tenancy, topic_id, region, percentage, services):
-    limit_values = {}
-    body_email = []
+def chunk_alerts(bodies, max_bytes=65000):
+    """ Packs alert bodies into messages of at most max_bytes bytes
+
+    The bodies are separated by an empty line and never split between two messages,
+    a single body over max_bytes is truncated.
+
+    Parameters:
+    bodies: The alert bodies
+    max_bytes: The maximum size of a message body in bytes
+
+    Returns:
+    The list of message bodies
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for body in bodies:
+        encoded = str(body).encode()
+        if len(encoded) > max_bytes:
+            encoded = encoded[:max_bytes]
+            body = encoded.decode(errors="ignore")
+        if len(chunk) > 0 and size + 2 + len(encoded) > max_bytes:
+            chunks.append("\n\n".join(chunk))
+            chunk = []
+            size = 0
+        size += len(encoded) + (2 if len(chunk) > 0 else 0)
+        chunk.append(str(body))
+    if len(chunk) > 0:
+        chunks.append("\n\n".join(chunk))
+    return chunks
+
+
+def publish_alerts(topic_id, bodies, title, options=None):
+    """ Publishes alert bodies to a topic, packed into as few messages as the message size allows
+
+    Parameters:
+    topic_id: The id of the topic
+    bodies: The alert bodies
+    title: The title of the messages, numbered when the alerts need more than one message
+    options: The scan options
+
+    Returns:
+    None
+    """
+    if options == None:
+        options = {}
+    chunks = chunk_alerts(bodies, options.get("message_max_bytes", 65000))
+    for index, chunk in enumerate(chunks):
+        if len(chunks) > 1:
+            publish_message(topic_id, chunk, "{} ({}/{})".format(title, index + 1, len(chunks)))
+        else:
+            publish_message(topic_id, chunk, title)
+        with stats_lock:
+            notification_stats["messages"] += 1
+            notification_stats["bytes"] += len(chunk.encode())
+            notification_stats["max_bytes"] = max(
+                notification_stats["max_bytes"], len(chunk.encode()))
+    add_stat(notification_stats, "alerts", len(bodies))
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=save_backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def get_object(namespace_name, bucket_name, object_name):
+    """ Gets an object from object storage
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the object
+
+    Returns:
+    The content of the object or None if the object does not exist
+    """
+    try:
+        return api_call(os_client.get_object, rate_limited=False)(namespace_name, bucket_name, object_name).data.content
+    except oci.exceptions.ServiceError as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=save_backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def put_object(namespace_name, bucket_name, object_name, put_object_body):
+    """ Adds an object to object storage
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the object
+    put_object_body: Body of the object
+
+    Returns:
+    None
+    """
+    logger.info("[INFO] Adding object {} to a bucket.".format(object_name))
+    api_call(os_client.put_object, rate_limited=False)(namespace_name, bucket_name,
+                                                        object_name, put_object_body)
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=save_backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def put_object_part(namespace_name, bucket_name, object_name, upload_id, part_num, body):
+    """ Uploads a part of a multipart upload
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the object
+    upload_id: The id of the multipart upload
+    part_num: The number of the part
+    body: The content of the part
+
+    Returns:
+    The etag of the part
+    """
+    return api_call(os_client.upload_part, rate_limited=False)(
+        namespace_name, bucket_name, object_name, upload_id, part_num, body).headers["etag"]
+
+
+@backoff.on_exception(backoff.expo, exception=oci.exceptions.ServiceError, max_time=save_backoff_max_time, giveup=is_throttling_error, on_backoff=record_backoff)
+def commit_object_parts(namespace_name, bucket_name, object_name, upload_id, parts):
+    """ Commits a multipart upload
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the object
+    upload_id: The id of the multipart upload
+    parts: The CommitMultipartUploadPartDetails of the uploaded parts
+
+    Returns:
+    None
+    """
+    api_call(os_client.commit_multipart_upload, rate_limited=False)(
+        namespace_name, bucket_name, object_name, upload_id,
+        oci.object_storage.models.CommitMultipartUploadDetails(parts_to_commit=parts))
+
+
+def snapshot_key(limit, ad):
+    """ Builds the key under which a limit is stored in the usage snapshot
+
+    Parameters:
+    limit: The limit definition
+    ad: The name of the availability domain or None
+
+    Returns:
+    A "service/limit/ad" string
+    """
+    return "{}/{}/{}".format(limit.service_name, limit.name, ad or "")
+
+
+def load_snapshot(region, options):
+    """ Loads the usage snapshot written by the previous run for a region
+
+    Parameters:
+    region: The region of the snapshot
+    options: The scan options, the snapshot is only used when bucket_name is set
+
+    Returns:
+    A dict with the run number, a limits dict of key -> [used, available, last_changed_run]
+    and the pending keys a previous run could not scan before its deadline
+    """
+    snapshot = {"run": 0, "limits": {}, "pending": []}
+    if not options.get("bucket_name"):
+        return snapshot
     try:
-        limits = list_limit_definition(tenancy)
+        content = get_object(options["namespace"], options["bucket_name"],
+                             "snapshots/{}.json".format(region))
     except Exception as e:
         logger.info(e)
-        if e.status_code == "429":
-            raise
-    if len(services) > 0:
-        limits = [limit for limit in limits if limit.service_name in services]
+        return snapshot
+    if content != None:
+        snapshot.update(json.loads(content))
+    return snapshot
 
-    for limit in limits:
-        if limit.scope_type == "AD":
+
+def save_snapshot(region, snapshot, checks, availabilities, options, pending=None):
+    """ Writes the usage observed by this run as the snapshot of a region
+
+    Parameters:
+    region: The region of the snapshot
+    snapshot: The snapshot returned by load_snapshot
+    checks: The planned (limit, ad_name) tuples
+    availabilities: The resource availabilities of the checks
+    options: The scan options
+    pending: The keys of the checks that were not scanned yet, scanned first by the next run
+
+    Returns:
+    None
+    """
+    if not options.get("bucket_name"):
+        return
+    run = snapshot["run"] + 1
+    previous = snapshot["limits"]
+    limits = {}
+    for (limit, ad), resource_availability in zip(checks, availabilities):
+        key = snapshot_key(limit, ad)
+        if resource_availability is None or resource_availability is DEADLINE_REACHED or \
+                resource_availability.used == None or resource_availability.available == None:
+            if key in previous:
+                limits[key] = previous[key]
+            continue
+        used = int(resource_availability.used)
+        available = int(resource_availability.available)
+        if key in previous and previous[key][0] == used and previous[key][1] == available:
+            limits[key] = [used, available, previous[key][2]]
+        else:
+            limits[key] = [used, available, run]
+    try:
+        put_object(options["namespace"], options["bucket_name"], "snapshots/{}.json".format(region),
+                   json.dumps({"run": run, "limits": limits, "pending": pending or []}, separators=(',', ':')))
+    except Exception as e:
+        logger.info(e)
+
+
+def load_alert_state(region, options):
+    """ Loads the alerts already published for the breached limits of a region
+
+    Parameters:
+    region: The region of the alert state
+    options: The scan options, the state is only used when alert_dedup is set
+
+    Returns:
+    A dict with the time of the last digest, the breaches dict of key -> [first_seen, notified, notified_percentage]
+    and the forecasts dict of key -> notified
+    """
+    state = {"digest": 0, "breaches": {}, "forecasts": {}}
+    if not options.get("alert_dedup"):
+        return state
+    try:
+        content = get_object(options["namespace"], options["bucket_name"],
+                             "alerts/{}.json".format(region))
+    except Exception as e:
+        logger.info(e)
+        return state
+    if content != None:
+        state.update(json.loads(content))
+    return state
+
+
+def save_alert_state(region, state, options):
+    """ Writes the alert state of a region
+
+    Parameters:
+    region: The region of the alert state
+    state: The state returned by load_alert_state
+    options: The scan options
+
+    Returns:
+    None
+    """
+    if not options.get("alert_dedup"):
+        return
+    try:
+        put_object(options["namespace"], options["bucket_name"], "alerts/{}.json".format(region),
+                   json.dumps(state, separators=(',', ':')))
+    except Exception as e:
+        logger.info(e)
+
+
+def filter_alerts(state, breaches, forecasts, evaluated, now, options):
+    """ Decides which alerts are published, based on what previous runs already published
+
+    A breach is published when it is new or when its available percentage dropped by
+    alert_step points since it was last published. A breached limit that is back over the
+    threshold is published as resolved. Ongoing breaches and forecasts are only repeated
+    in a digest every alert_digest_hours, counted from the first published breach.
+
+    Parameters:
+    state: The state returned by load_alert_state, updated in place
+    breaches: The (key, body, percentage) tuples of the limits under the threshold
+    forecasts: The (key, body) tuples of the limits forecast to run out
+    evaluated: A dict of key -> resolution body of the previously breached limits evaluated over the threshold
+    now: The time of the run as a timestamp
+    options: The scan options
+
+    Returns:
+    The list of bodies to publish
+    """
+    if not options.get("alert_dedup"):
+        return [body for key, body, percentage in breaches] + [body for key, body in forecasts]
+    step = options.get("alert_step", 10)
+    digest_due = now - state["digest"] >= options.get("alert_digest_hours", 24) * 3600
+    bodies = []
+    ongoing = []
+    for key, body, percentage in breaches:
+        previous = state["breaches"].get(key)
+        if previous == None:
+            state["breaches"][key] = [now, now, percentage]
+            bodies.append(body)
+            add_stat(alert_stats, "new")
+            if state["digest"] == 0:
+                # The digest schedule starts with the first published breach
+                state["digest"] = now
+        elif percentage <= previous[2] - step:
+            state["breaches"][key] = [previous[0], now, percentage]
+            bodies.append("Worsened since {}: {}".format(
+                datetime.fromtimestamp(previous[1], timezone.utc).strftime('%Y-%m-%d %H:%M'), body))
+            add_stat(alert_stats, "worsened")
+        else:
+            ongoing.append("Ongoing since {}: {}".format(
+                datetime.fromtimestamp(previous[0], timezone.utc).strftime('%Y-%m-%d %H:%M'), body))
+    for key in list(state["breaches"]):
+        if key in evaluated:
+            bodies.append(evaluated[key])
+            del state["breaches"][key]
+            add_stat(alert_stats, "resolved")
+    for key, body in forecasts:
+        if now - state["forecasts"].get(key, 0) >= options.get("alert_digest_hours", 24) * 3600:
+            state["forecasts"][key] = now
+            bodies.append(body)
+        else:
+            ongoing.append(body)
+    forecast_keys = set(key for key, body in forecasts)
+    state["forecasts"] = {key: notified for key, notified in state["forecasts"].items()
+                          if key in forecast_keys}
+    if len(ongoing) > 0 and digest_due:
+        state["digest"] = now
+        bodies.append("Digest of the alerts already published:\n" + "\n".join(ongoing))
+        add_stat(alert_stats, "digests")
+    else:
+        add_stat(alert_stats, "suppressed", len(ongoing))
+    return bodies
+
+
+def select_checks(checks, snapshot, percentage, options):
+    """ Decides which planned checks are scanned in this run
+
+    A limit is hot when it was never seen, when its available percentage is within
+    hot_margin of the threshold or when it changed in the last cold_scan_interval runs.
+    Hot limits are scanned on every run, cold limits once every cold_scan_interval runs.
+
+    Parameters:
+    checks: The planned (limit, ad_name) tuples
+    snapshot: The snapshot returned by load_snapshot
+    percentage: The alert threshold
+    options: The scan options
+
+    Returns:
+    A list of bools in the same order as checks, True for the checks that should be scanned
+    """
+    interval = options.get("cold_scan_interval", 1)
+    if interval <= 1:
+        return [True] * len(checks)
+    margin = options.get("hot_margin", 10)
+    policies = options.get("policies") or ThresholdPolicies(percentage=percentage)
+    run = snapshot["run"]
+    scan = []
+    for limit, ad in checks:
+        key = snapshot_key(limit, ad)
+        previous = snapshot["limits"].get(key)
+        if previous == None:
+            scan.append(True)
+            continue
+        used, available, changed_run = previous
+        hot = run - changed_run < interval
+        if used + available > 0 and available * 100 / (used + available) < policies.lookup(limit.service_name, limit.name)[0] + margin:
+            hot = True
+        scan.append(hot or (run + zlib.crc32(key.encode())) % interval == 0)
+    return scan
+
+
+def history_prefix(region, day):
+    """ Builds the prefix of the usage history objects of a region and day
+
+    Parameters:
+    region: The region of the history
+    day: The day as a datetime
+
+    Returns:
+    A "history/<region>/<YYYY-MM-DD>/" string
+    """
+    return "history/{}/{}/".format(region, day.strftime('%Y-%m-%d'))
+
+
+def append_history(region, timestamp, checks, availabilities, options):
+    """ Appends the usage scanned by this run to the history of a region
+
+    Every run writes one small CSV object under the prefix of its day, so appending never
+    rewrites older samples and the last N days are found by listing N prefixes.
+
+    Parameters:
+    region: The region of the history
+    timestamp: The time of the run as a datetime
+    checks: The planned (limit, ad_name) tuples
+    availabilities: The resource availabilities scanned by this run, None for the others
+    options: The scan options
+
+    Returns:
+    None
+    """
+    content = io.StringIO()
+    history = csv.writer(content)
+    for (limit, ad), resource_availability in zip(checks, availabilities):
+        if resource_availability is None or resource_availability is DEADLINE_REACHED or \
+                resource_availability.used == None or resource_availability.available == None:
+            continue
+        history.writerow([limit.service_name, limit.name, ad or "",
+                          int(resource_availability.used), int(resource_availability.available)])
+    if content.tell() == 0:
+        return
+    try:
+        put_object(options["namespace"], options["bucket_name"], history_prefix(region, timestamp) + timestamp.strftime('%H%M%S.csv'),
+                   content.getvalue())
+    except Exception as e:
+        logger.info(e)
+
+
+def load_history(region, now, options):
+    """ Reads the usage history of a region for the last history_days days
+
+    The history is read newest day first and the read stops at the deadline of the run, so
+    the alerts found by the scan are still published within the deadline margin. The
+    forecasts then use the days read so far.
+
+    Parameters:
+    region: The region of the history
+    now: The time of the run as a datetime
+    options: The scan options
+
+    Returns:
+    A dict of snapshot key -> list of (timestamp, used, available) samples, oldest first
+    """
+    samples = {}
+    for days_ago in range(options["history_days"] + 1):
+        if run_deadline != None and time.monotonic() >= run_deadline:
+            logger.info("[INFO] Deadline reached in {}, the forecasts use the last {} days of history".format(
+                region, days_ago))
+            break
+        day = now - timedelta(days=days_ago)
+        try:
+            objects = oci.pagination.list_call_get_all_results(api_call(os_client.list_objects, rate_limited=False), options["namespace"],
+                                                               options["bucket_name"], prefix=history_prefix(region, day), fields="name").data.objects
+        except Exception as e:
+            logger.info(e)
+            continue
+        for history_object in sorted(objects, key=lambda history_object: history_object.name, reverse=True):
+            if run_deadline != None and time.monotonic() >= run_deadline:
+                break
+            timestamp = datetime.strptime(history_object.name[-21:], '%Y-%m-%d/%H%M%S.csv').replace(
+                tzinfo=timezone.utc).timestamp()
+            if timestamp < (now - timedelta(days=options["history_days"])).timestamp():
+                continue
             try:
-                ads = identity_client.list_availability_domains(tenancy)
+                content = get_object(
+                    options["namespace"], options["bucket_name"], history_object.name)
             except Exception as e:
                 logger.info(e)
+                continue
+            if content == None:
+                continue
+            for service_name, limit_name, ad, used, available in csv.reader(io.StringIO(content.decode())):
+                samples.setdefault("{}/{}/{}".format(service_name, limit_name, ad), []).append(
+                    (timestamp, int(used), int(available)))
+    for key in samples:
+        samples[key].sort()
+    return samples
 
-            for ad in ads.data:
-                try:
-                    resource_availability = get_resource_availability(
-                        tenancy, limit.service_name, limit.name, ad.name)
-                except Exception as e:
-                    logger.info(e)
-                    if e.status_code == "429":
-                        raise
-                if resource_availability.used != None and resource_availability.available != None:
-                    if int(resource_availability.used) + int(resource_availability.available) > 0:
-                        total_available = int(resource_availability.available)*100/(
-                            int(resource_availability.used)+int(resource_availability.available))
-                        logger.info("Service {}       Ad {}              Limit_Name {}              Available {}        Used {}       Total {}{}".format(
-                            limit.service_name, ad.name, limit.name, resource_availability.available, resource_availability.used, total_available, '%'))
-                        limit_values[limit.name + "_" + region] = "Available Resources: {}{}".format(
-                            total_available, '%')
-                        if int(total_available) < percentage:
-                            body = "Limit reached for {}. Info: Service {}, Scope {}, AD {}, Limit_Name {}, Available {}, Used {}, Total {}{}".format(
-                                limit.name, limit.service_name, limit.scope_type, ad.name, limit.name, resource_availability.available, resource_availability.used, total_available, '%')
-                            body_email.append(body)
 
+def forecast_exhaustion(samples, min_samples=3):
+    """ Estimates in how many days a limit runs out with a least squares fit of its usage
+
+    Parameters:
+    samples: A list of (timestamp, used, available) samples, the last one being the current usage
+    min_samples: The number of samples needed for a forecast
+
+    Returns:
+    The number of days until available reaches 0 or None when usage is not growing
+    """
+    if len(samples) < min_samples:
+        return None
+    mean_time = sum(sample[0] for sample in samples) / len(samples)
+    mean_used = sum(sample[1] for sample in samples) / len(samples)
+    variance = sum((sample[0] - mean_time) ** 2 for sample in samples)
+    if variance == 0:
+        return None
+    slope = sum((sample[0] - mean_time) * (sample[1] - mean_used)
+                for sample in samples) / variance
+    if slope <= 0:
+        return None
+    return samples[-1][2] / (slope * 86400)
+
+
+def order_by_risk(checks, indexes, snapshot, percentage, options):
+    """ Orders the checks so the ones most likely to alert are scanned first
+
+    Limits within hot_margin of the threshold come first, then the limits the previous run
+    could not scan before its deadline, then the unknown limits and then the rest by their
+    previous available percentage.
+
+    Parameters:
+    checks: The planned (limit, ad_name) tuples
+    indexes: The indexes of the checks that should be scanned
+    snapshot: The snapshot returned by load_snapshot
+    percentage: The alert threshold
+    options: The scan options
+
+    Returns:
+    The indexes in scan order
+    """
+    pending = set(snapshot.get("pending", []))
+    margin = options.get("hot_margin", 10)
+    policies = options.get("policies") or ThresholdPolicies(percentage=percentage)
+
+    def risk(index):
+        limit, ad = checks[index]
+        key = snapshot_key(limit, ad)
+        previous = snapshot["limits"].get(key)
+        if previous != None and previous[0] + previous[1] > 0:
+            available = previous[1] * 100 / (previous[0] + previous[1])
+            if available < policies.lookup(limit.service_name, limit.name)[0] + margin:
+                return (0, available)
+        else:
+            available = 0
+        if key in pending:
+            return (1, available)
+        if previous == None:
+            return (2, 0)
+        return (3, available)
+
+    return sorted(indexes, key=risk)
+
+
+def scan_checks(tenancy, region, checks, scan, snapshot, percentage, concurrency=1, options=None):
+    """ Scans the selected checks in risk order until they are done or the deadline of the run is reached
+
+    Progress is written to the snapshot every checkpoint_size checks, so a run that is killed
+    is resumed by the next one.
+
+    Parameters:
+    tenancy: The id of the tenancy
+    region: The region of the limits
+    checks: The planned (limit, ad_name) tuples
+    scan: The list returned by select_checks
+    snapshot: The snapshot returned by load_snapshot
+    percentage: The alert threshold
+    concurrency: The number of calls that are made in parallel
+    options: The scan options
+
+    Returns:
+    availabilities - The resource availabilities in the same order as checks, DEADLINE_REACHED for the checks that were not scanned
+
+    pending - The snapshot keys of the checks that were not scanned
+    """
+    availabilities = [DEADLINE_REACHED] * len(checks)
+    order = order_by_risk(checks, [index for index, selected in enumerate(
+        scan) if selected], snapshot, percentage, options)
+    checkpoint_size = options.get("checkpoint_size", 500)
+    for start in range(0, len(order), checkpoint_size):
+        if run_deadline != None and time.monotonic() >= run_deadline:
+            break
+        batch = order[start:start + checkpoint_size]
+        results = run_availability_checks(
+            tenancy, [checks[index] for index in batch], concurrency, region)
+        for index, resource_availability in zip(batch, results):
+            availabilities[index] = resource_availability
+        if start + checkpoint_size < len(order):
+            save_snapshot(region, snapshot, checks, availabilities, options, [snapshot_key(*checks[index])
+                                                                              for index in order if availabilities[index] is DEADLINE_REACHED])
+    pending = [snapshot_key(*checks[index])
+               for index in order if availabilities[index] is DEADLINE_REACHED]
+    return availabilities, pending
+
+
+def fetch_limit_values(tenancy, service_name, region=None):
+    """ Gets the limit values of a service indexed by limit name and availability domain
+
+    Parameters:
+    tenancy: The id of the tenancy
+    service_name: The name of the service
+    region: The region of the limits
+
+    Returns:
+    A dict of (limit_name, ad_name) -> value or None if the values could not be retrieved
+    """
+    try:
+        values = list_limit_values(tenancy, service_name, region)
+    except Exception as e:
+        logger.info(e)
+        if getattr(e, "status", None) == 429:
+            raise
+        return None
+    return {(value.name, value.availability_domain): value.value for value in values}
+
+
+def plan_availability_checks(tenancy, limits, region, concurrency=1):
+    """ Expands the limit definitions into the resource availability calls that have to be made
+
+    The limit values of every service are listed in bulk first, so limits that do not
+    support resource availability or have a value of 0 are skipped without a call.
+
+    Parameters:
+    tenancy: The id of the tenancy
+    limits: The limit definitions that should be checked
+    region: The region in which the limits are checked
+    concurrency: The number of services whose limit values are listed in parallel
+
+    Returns:
+    A list of (limit, ad_name) tuples in scan order. ad_name is None for non AD limits
+    """
+    supported = []
+    for limit in limits:
+        if limit.is_resource_availability_supported == False:
+            add_stat(plan_stats, "skipped_unsupported")
         else:
+            supported.append(limit)
+
+    service_names = sorted(set(limit.service_name for limit in supported))
+    if concurrency <= 1 or len(service_names) <= 1:
+        service_values = [fetch_limit_values(tenancy, service_name, region)
+                          for service_name in service_names]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(service_names))) as executor:
+            service_values = list(executor.map(
+                lambda service_name: fetch_limit_values(tenancy, service_name, region), service_names))
+    add_stat(plan_stats, "limit_value_calls", len(service_names))
+    values = dict(zip(service_names, service_values))
+
+    checks = []
+    for limit in supported:
+        limit_values = values[limit.service_name]
+        if limit.scope_type == "AD":
             try:
-                resource_availability = get_resource_availability(
-                    tenancy, limit.service_name, limit.name)
+                ads = get_availability_domains(tenancy, region)
             except Exception as e:
                 logger.info(e)
-                if e.status_code == "429":
-                    raise
-            if resource_availability.used != None and resource_availability.available != None:
-                if int(resource_availability.used) + int(resource_availability.available) > 0:
-                    total_available = int(resource_availability.available)*100/(
-                        int(resource_availability.used)+int(resource_availability.available))
-                    logger.info("Service {}       Scope {}       Limit_Name {}       Available {}        Used {}       Total {}{}".format(
-                        limit.service_name, limit.scope_type, limit.name, resource_availability.available, resource_availability.used, total_available, '%'))
-                    limit_values[limit.name + "_" + region] = "Available Resources: {}{}".format(
-                        total_available, '%')
-                    if int(total_available) < percentage:
+                continue
+        else:
+            ads = [None]
+        for ad in ads:
+            if limit_values != None and limit_values.get((limit.name, ad)) == 0:
+                add_stat(plan_stats, "skipped_zero")
+                continue
+            checks.append((limit, ad))
+    add_stat(plan_stats, "availability_calls", len(checks))
+    return checks
+
+
+def fetch_availability(tenancy, check, region=None):
+    """ Gets the resource availability for a single planned check
+
+    Parameters:
+    tenancy: The id of the tenancy
+    check: A (limit, ad_name) tuple
+    region: The region of the limit
+
+    Returns:
+    The resource availability, None if it could not be retrieved or DEADLINE_REACHED if there is no time
+    left, including when the call is still throttled at the deadline
+    """
+    if run_deadline != None and time.monotonic() >= run_deadline:
+        return DEADLINE_REACHED
+    limit, ad = check
+    try:
+        return get_resource_availability(tenancy, limit.service_name, limit.name, ad, region)
+    except Exception as e:
+        logger.info(e)
+        if getattr(e, "status", None) == 429:
+            if run_deadline != None and time.monotonic() >= run_deadline:
+                return DEADLINE_REACHED
+            raise
+    return None
+
+
+def add_stat(stats, key, value=1):
+    """ Adds a value to a run counter, regions can be scanned from several threads
+
+    Parameters:
+    stats: The counters dict
+    key: The name of the counter
+    value: The value added to the counter
+
+    Returns: None
+    """
+    with stats_lock:
+        stats[key] += value
+
+
+def reset_plan_stats():
+    """ Resets the counters of the planning stage
+
+    Parameters: None
+
+    Returns: None
+    """
+    plan_stats.update({
+        "limit_value_calls": 0,
+        "availability_calls": 0,
+        "skipped_unsupported": 0,
+        "skipped_zero": 0,
+        "skipped_global": 0
+    })
+    scan_stats.update({
+        "scanned": 0,
+        "skipped_cold": 0,
+        "deadline_skipped": 0,
+        "evaluated": 0,
+        "forecast_alerts": 0,
+        "estimated_saved_seconds": 0.0
+    })
+    notification_stats.update({
+        "messages": 0,
+        "alerts": 0,
+        "bytes": 0,
+        "max_bytes": 0
+    })
+    alert_stats.update({
+        "new": 0,
+        "worsened": 0,
+        "resolved": 0,
+        "suppressed": 0,
+        "digests": 0
+    })
+
+
+def run_availability_checks(tenancy, checks, concurrency=1, region=None):
+    """ Runs the planned resource availability checks
+
+    Parameters:
+    tenancy: The id of the tenancy
+    checks: The (limit, ad_name) tuples returned by plan_availability_checks
+    concurrency: The number of calls that are made in parallel. 1 means sequential
+    region: The region of the limits
+
+    Returns:
+    A list of resource availabilities in the same order as checks
+    """
+    if concurrency <= 1 or len(checks) <= 1:
+        return [fetch_availability(tenancy, check, region) for check in checks]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(checks))) as executor:
+        return list(executor.map(lambda check: fetch_availability(tenancy, check, region), checks))
+
+
+def prepare_checks(tenancy, region, percentage, services, concurrency=1, options=None):
+    """ Lists, filters and plans the limits of a region and selects the ones scanned by this run
+
+    Parameters:
+    tenancy: The id of the tenancy
+    region: The region of the limits
+    percentage: The alert threshold
+    services: The services to check, used when options has no limit_filter
+    concurrency: The number of services whose limit values are listed in parallel
+    options: The scan options
+
+    Returns:
+    checks - The planned (limit, ad_name) tuples
+
+    snapshot - The snapshot returned by load_snapshot
+
+    scan - The list returned by select_checks
+    """
+    try:
+        limits = list_limit_definition(tenancy, region)
+    except Exception as e:
+        logger.info(e)
+        if getattr(e, "status", None) == 429:
+            raise
+        limits = []
+    limit_filter = options.get("limit_filter")
+    if limit_filter == None:
+        limit_filter = LimitFilter(services)
+    limits = limit_filter.apply(limits)
+    if options.get("global_region") != None and region != options["global_region"]:
+        regional = [limit for limit in limits if limit.scope_type != "GLOBAL"]
+        add_stat(plan_stats, "skipped_global", len(limits) - len(regional))
+        limits = regional
+
+    checks = plan_availability_checks(tenancy, limits, region, concurrency)
+    snapshot = load_snapshot(region, options)
+    scan = select_checks(checks, snapshot, percentage, options)
+    return checks, snapshot, scan
+
+
+def evaluate_checks(topic_id, region, percentage, checks, snapshot, scan, availabilities, pending, elapsed, options):
+    """ Evaluates the scanned limits of a region, publishes the alerts and saves the snapshot
+
+    In digest mode the alerts and the alert state are kept in options, finish_regions
+    publishes them with the other regions and then saves the state.
+
+    Parameters:
+    topic_id: The id of the topic
+    region: The region of the limits
+    percentage: The alert threshold
+    checks: The planned (limit, ad_name) tuples
+    snapshot: The snapshot returned by load_snapshot
+    scan: The list returned by select_checks
+    availabilities: The resource availabilities returned by the scan
+    pending: The snapshot keys of the checks the scan did not reach
+    elapsed: The seconds the scan took
+    options: The scan options
+
+    Returns:
+    The records of the checked limits or, for the legacy result_format, a dict of limit name -> available percentage
+    """
+    writer = options.get("writer")
+    collect_values = options.get("collect_values", True)
+    result_format = options.get("result_format", "records")
+    limit_values = {}
+    records = []
+    breaches = []
+    forecasts = []
+    resolved = {}
+    scanned = len([selected for selected in scan if selected]) - len(pending)
+    skipped = len(checks) - scanned - len(pending)
+    add_stat(scan_stats, "scanned", scanned)
+    add_stat(scan_stats, "skipped_cold", skipped)
+    add_stat(scan_stats, "deadline_skipped", len(pending))
+    if len(pending) > 0:
+        logger.info("[INFO] Deadline reached in {}, {} checks left for the next run".format(
+            region, len(pending)))
+    if scanned > 0:
+        add_stat(scan_stats, "estimated_saved_seconds",
+                 skipped * elapsed / scanned)
+
+    for index, ((limit, ad), selected) in enumerate(zip(checks, scan)):
+        if not selected:
+            used, available, changed_run = snapshot["limits"][snapshot_key(
+                limit, ad)]
+            availabilities[index] = oci.limits.models.ResourceAvailability(
+                used=used, available=available)
+
+    now = datetime.now(timezone.utc)
+    history = None
+    if options.get("bucket_name") and options.get("history_days", 0) > 0:
+        history = load_history(region, now, options)
+        append_history(region, now, checks, [availability if selected else None for availability, selected in zip(availabilities, scan)],
+                       options)
+    alert_state = load_alert_state(region, options)
+    policies = options.get("policies") or ThresholdPolicies(percentage=percentage)
+
+    for (limit, ad), resource_availability in zip(checks, availabilities):
+        if resource_availability is None or resource_availability is DEADLINE_REACHED:
+            continue
+        key = snapshot_key(limit, ad)
+        if resource_availability.used != None and resource_availability.available != None:
+            if int(resource_availability.used) + int(resource_availability.available) > 0:
+                total_available = int(resource_availability.available)*100/(
+                    int(resource_availability.used)+int(resource_availability.available))
+                if ad != None:
+                    logger.debug("Service %s       Ad %s              Limit_Name %s              Available %s        Used %s       Total %s%%",
+                                 limit.service_name, ad, limit.name, resource_availability.available, resource_availability.used, total_available)
+                else:
+                    logger.debug("Service %s       Scope %s       Limit_Name %s       Available %s        Used %s       Total %s%%",
+                                 limit.service_name, limit.scope_type, limit.name, resource_availability.available, resource_availability.used, total_available)
+                record = {"region": region, "service": limit.service_name, "limit": limit.name, "ad": ad,
+                          "used": int(resource_availability.used), "available": int(resource_availability.available),
+                          "percentage": round(total_available, 2)}
+                add_stat(scan_stats, "evaluated")
+                if writer != None:
+                    writer.write(record)
+                if collect_values:
+                    if result_format == "legacy":
+                        limit_values[limit.name + "_" + region] = "Available Resources: {}{}".format(
+                            total_available, '%')
+                    else:
+                        records.append(record)
+                if policies.is_breached(limit.service_name, limit.name, int(resource_availability.used), int(resource_availability.available)):
+                    if ad != None:
+                        body = "Limit reached for {}. Info: Service {}, Scope {}, AD {}, Limit_Name {}, Available {}, Used {}, Total {}{}".format(
+                            limit.name, limit.service_name, limit.scope_type, ad, limit.name, resource_availability.available, resource_availability.used, total_available, '%')
+                    else:
                         body = "Limit reached for {}. Info: Service {}, Scope {}, Limit_Name {}, Available {}, Used {}, Total {}{}".format(
                             limit.name, limit.service_name, limit.scope_type, limit.name, resource_availability.available, resource_availability.used, total_available, '%')
-                        body_email.append(body)
+                    breaches.append((key, body, total_available))
+                    continue
+                if key in alert_state["breaches"]:
+                    if ad != None:
+                        resolved[key] = "Limit resolved for {}. Info: Service {}, Scope {}, AD {}, Limit_Name {}, Available {}, Used {}, Total {}{}".format(
+                            limit.name, limit.service_name, limit.scope_type, ad, limit.name, resource_availability.available, resource_availability.used, total_available, '%')
+                    else:
+                        resolved[key] = "Limit resolved for {}. Info: Service {}, Scope {}, Limit_Name {}, Available {}, Used {}, Total {}{}".format(
+                            limit.name, limit.service_name, limit.scope_type, limit.name, resource_availability.available, resource_availability.used, total_available, '%')
+                if history != None and options.get("forecast_days", 14) > 0:
+                    days = forecast_exhaustion(history.get(key, []) + [
+                        (now.timestamp(), int(resource_availability.used), int(resource_availability.available))], options.get("forecast_min_samples", 3))
+                    if days != None and days < options.get("forecast_days", 14):
+                        if ad != None:
+                            body = "Limit forecast for {}. Info: Service {}, Scope {}, AD {}, Limit_Name {}, Available {}, Used {}, Days to exhaustion {}".format(
+                                limit.name, limit.service_name, limit.scope_type, ad, limit.name, resource_availability.available, resource_availability.used, round(days, 1))
+                        else:
+                            body = "Limit forecast for {}. Info: Service {}, Scope {}, Limit_Name {}, Available {}, Used {}, Days to exhaustion {}".format(
+                                limit.name, limit.service_name, limit.scope_type, limit.name, resource_availability.available, resource_availability.used, round(days, 1))
+                        forecasts.append((key, body))
+                        add_stat(scan_stats, "forecast_alerts")
 
     title = "Region {} Limit exceeds for {} {} treshold".format(
         region, percentage, '%')
-    message_body = "\n\n".join(str(body) for body in body_email)
-    if len(message_body) > 0:
-        publish_message(topic_id, message_body, title)
-    return limit_values
+    body_email = filter_alerts(alert_state, breaches, forecasts,
+                               resolved, now.timestamp(), options)
+    if options.get("notification_mode", "region") == "digest":
+        options["digest_alerts"][region] = body_email
+        options["digest_states"][region] = alert_state
+    else:
+        if len(body_email) > 0:
+            publish_alerts(topic_id, body_email, title, options)
+        save_alert_state(region, alert_state, options)
+    save_snapshot(region, snapshot, checks,
+                  availabilities, options, pending)
+    if result_format == "legacy":
+        return limit_values
+    return records
+
+
+def check_limits(tenancy, topic_id, region, percentage, services, concurrency=1, options=None):
+    if options == None:
+        options = {}
+    checks, snapshot, scan = prepare_checks(
+        tenancy, region, percentage, services, concurrency, options)
+    start = time.monotonic()
+    availabilities, pending = scan_checks(
+        tenancy, region, checks, scan, snapshot, percentage, concurrency, options)
+    return evaluate_checks(topic_id, region, percentage, checks, snapshot, scan, availabilities, pending,
+                           time.monotonic() - start, options)
+
+
+async def scan_checks_async(tenancy, region, checks, scan, snapshot, percentage, call, options):
+    """ Scans the selected checks like scan_checks, with every check as an asyncio task
+
+    The tasks still running when the deadline of the run is reached are cancelled and
+    returned as pending, so the next run starts with them.
+
+    Parameters:
+    tenancy: The id of the tenancy
+    region: The region of the limits
+    checks: The planned (limit, ad_name) tuples
+    scan: The list returned by select_checks
+    snapshot: The snapshot returned by load_snapshot
+    percentage: The alert threshold
+    call: A coroutine function running a blocking function under the concurrency cap of the run
+    options: The scan options
+
+    Returns:
+    The same availabilities and pending as scan_checks
+    """
+    availabilities = [DEADLINE_REACHED] * len(checks)
+    order = order_by_risk(checks, [index for index, selected in enumerate(
+        scan) if selected], snapshot, percentage, options)
+    checkpoint_size = options.get("checkpoint_size", 500)
+    tasks = {asyncio.ensure_future(call(fetch_availability, tenancy, checks[index], region)): index
+             for index in order}
+    waiting = set(tasks)
+    done_count = 0
+    try:
+        while len(waiting) > 0:
+            timeout = None
+            if run_deadline != None:
+                timeout = max(0, run_deadline - time.monotonic())
+            done, waiting = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for task in done:
+                availabilities[tasks[task]] = task.result()
+            if done_count // checkpoint_size != (done_count + len(done)) // checkpoint_size and len(waiting) > 0:
+                await call(save_snapshot, region, snapshot, checks, availabilities, options,
+                           [snapshot_key(*checks[index]) for index in order if availabilities[index] is DEADLINE_REACHED])
+            done_count += len(done)
+    finally:
+        for task in waiting:
+            task.cancel()
+    pending = [snapshot_key(*checks[index])
+               for index in order if availabilities[index] is DEADLINE_REACHED]
+    return availabilities, pending
+
+
+async def check_limits_async(tenancy, topic_id, region, percentage, services, concurrency, options, call):
+    """ Checks the limits of a region like check_limits, with the resource availability calls run as asyncio tasks
+
+    Parameters:
+    tenancy: The id of the tenancy
+    topic_id: The id of the topic
+    region: The region of the limits
+    percentage: The alert threshold
+    services: The services to check
+    concurrency: The number of services whose limit values are listed in parallel
+    options: The scan options
+    call: A coroutine function running a blocking function under the concurrency cap of the run
+
+    Returns:
+    The same result as check_limits
+    """
+    checks, snapshot, scan = await call(prepare_checks, tenancy, region, percentage, services, concurrency, options)
+    start = time.monotonic()
+    availabilities, pending = await scan_checks_async(
+        tenancy, region, checks, scan, snapshot, percentage, call, options)
+    return await call(evaluate_checks, topic_id, region, percentage, checks, snapshot, scan, availabilities, pending,
+                      time.monotonic() - start, options)
+
+
+def encode_columnar(records):
+    """ Encodes limit records column by column, with the repeated strings replaced by indexes
+
+    Parameters:
+    records: The records returned by check_limits
+
+    Returns:
+    A dict with the column names, the dictionaries of the string columns and the column values
+    """
+    columns = ["region", "service", "limit", "ad",
+               "used", "available", "percentage"]
+    dictionaries = {"region": [], "service": [], "limit": [], "ad": []}
+    indexes = {column: {} for column in dictionaries}
+    data = {column: [] for column in columns}
+    for record in records:
+        for column in columns:
+            value = record[column]
+            if column in dictionaries:
+                index = indexes[column].get(value)
+                if index == None:
+                    index = len(dictionaries[column])
+                    indexes[column][value] = index
+                    dictionaries[column].append(value)
+                value = index
+            data[column].append(value)
+    return {"columns": columns, "dictionaries": dictionaries, "data": data}
+
+
+def post_call_metrics(compartment_id, namespace="limits_monitoring"):
+    """ Posts the call counters of this run as OCI Monitoring custom metrics
+
+    Parameters:
+    compartment_id: The compartment of the metrics
+    namespace: The custom metric namespace
+
+    Returns:
+    None
+    """
+    home_region = [reg.region_name for reg in get_region_subscriptions(
+        get_signer().tenancy_id) if reg.is_home_region][0]
+    key = ("monitoring", home_region)
+    with clients_lock:
+        client = clients.get(key)
+        if client == None:
+            client = oci.monitoring.MonitoringClient(dict(default_config, region=home_region), signer=signer,
+                                                     service_endpoint="https://telemetry-ingestion.{}.oraclecloud.com".format(home_region))
+            clients[key] = client
+    timestamp = datetime.now(timezone.utc)
+    metric_data = []
+    for operation in call_metrics.stats()["operations"]:
+        dimensions = {"operation": operation["operation"],
+                      "region": operation["region"]}
+        for name, value in [("CallCount", operation["count"]),
+                            ("CallLatency", operation["seconds"] * 1000 / max(operation["count"], 1)),
+                            ("ThrottledCount", operation["throttled"]),
+                            ("RetryCount", operation["retries"])]:
+            metric_data.append(oci.monitoring.models.MetricDataDetails(
+                namespace=namespace, compartment_id=compartment_id, name=name, dimensions=dimensions,
+                datapoints=[oci.monitoring.models.Datapoint(timestamp=timestamp, value=value)]))
+    for index in range(0, len(metric_data), 50):
+        client.post_metric_data(oci.monitoring.models.PostMetricDataDetails(
+            metric_data=metric_data[index:index + 50]))
+
+
+def prepare_regions(regions, options):
+    """ Initializes the clients and lists the regions that have to be checked
+
+    Parameters:
+    regions: The regions to check as a list or a comma separated string, empty for all of the subscribed regions
+    options: The scan options, namespace, home_region and global_region are set on them
+
+    Returns:
+    tenancy - The id of the tenancy
 
+    namespace - The object storage namespace
 
-def main(regions, topic_id, percentage, services):
+    scan_regions - The names of the regions to check
+    """
     signer, limits_client, quotas_client, search_client, identity_client, notifications_client, os_client = initialize()
     tenancy = signer.tenancy_id
-    region_data = identity_client.list_region_subscriptions(tenancy)
-    namespace = os_client.get_namespace().data
-    limits = []
-    for reg in region_data.data:
-        signer, limits_client, quotas_client, search_client, identity_client, notifications_client, os_client = initialize(
-            region=reg.region_name)
-        if len(regions) == 0:
-            limit_values = check_limits(
-                tenancy, topic_id, reg.region_name, percentage, services)
-            limits.append(limit_values)
+    namespace = api_call(os_client.get_namespace,
+                         rate_limited=False)().data
+    options["namespace"] = namespace
+    if options.get("writer") != None:
+        options["writer"].namespace = namespace
+    if isinstance(regions, str):
+        regions = [region.strip()
+                   for region in regions.split(',') if region.strip()]
+    subscriptions = get_region_subscriptions(tenancy)
+    scan_regions = [reg.region_name for reg in subscriptions
+                    if len(regions) == 0 or reg.region_name in regions]
+    options["home_region"] = next(
+        (reg.region_name for reg in subscriptions if reg.is_home_region), None)
+    if options.get("global_region") == None:
+        if options["home_region"] in scan_regions or len(scan_regions) == 0:
+            options["global_region"] = options["home_region"]
         else:
-            if ',' not in regions:
-                region_list = regions
-            else:
-                region_list = regions.split(',')
-            if reg.region_name in region_list:
-                limit_values = check_limits(
-                    tenancy, topic_id, reg.region_name, percentage, services)
-                limits.append(limit_values)
+            options["global_region"] = scan_regions[0]
+    return tenancy, namespace, scan_regions
+
+
+def finish_regions(limits, scan_regions, topic_id, percentage, options):
+    """ Publishes the cross region digest and merges the results of the regions
+
+    In digest mode the alert states of the regions are only saved once the digest is
+    published, so the alerts of a digest that failed are sent again by the next run.
+
+    Parameters:
+    limits: The results of check_limits, in the order of scan_regions
+    scan_regions: The names of the checked regions
+    topic_id: The id of the topic
+    percentage: The alert threshold
+    options: The scan options
+
+    Returns:
+    The records of all the regions or, for the legacy result_format, the list of the region dicts
+    """
+    if options.get("notification_mode", "region") == "digest":
+        bodies = []
+        alert_regions = 0
+        for region in scan_regions:
+            if len(options["digest_alerts"].get(region, [])) > 0:
+                alert_regions += 1
+                bodies.extend("[{}] {}".format(region, body)
+                              for body in options["digest_alerts"][region])
+        if alert_regions > 0:
+            publish_alerts(topic_id, bodies, "Limit exceeds for {} {} treshold in {} regions".format(
+                percentage, '%', alert_regions), options)
+        for region in scan_regions:
+            if region in options["digest_states"]:
+                save_alert_state(
+                    region, options["digest_states"][region], options)
+    if options.get("result_format", "records") != "legacy":
+        limits = [record for records in limits for record in records]
+    return limits
+
+
+def main(regions, topic_id, percentage, services, concurrency=1, options=None):
+    if options == None:
+        options = {}
+    tenancy, namespace, scan_regions = prepare_regions(regions, options)
+
+    def scan(region):
+        return check_limits(tenancy, topic_id, region, percentage, services, concurrency, options)
+
+    region_concurrency = options.get("region_concurrency", 1)
+    if region_concurrency <= 1 or len(scan_regions) <= 1:
+        limits = [scan(region) for region in scan_regions]
+    else:
+        with ThreadPoolExecutor(max_workers=min(region_concurrency, len(scan_regions))) as executor:
+            limits = list(executor.map(scan, scan_regions))
+    return finish_regions(limits, scan_regions, topic_id, percentage, options), namespace
+
+
+async def main_async(regions, topic_id, percentage, services, concurrency=1, options=None):
+    """ Checks the limits of the regions like main, on one asyncio event loop
+
+    Every region and every resource availability call is a task. The blocking SDK calls run
+    on a thread pool of async_concurrency threads, which caps the calls in flight for the
+    whole run.
+
+    Parameters:
+    regions: The regions to check
+    topic_id: The id of the topic
+    percentage: The alert threshold
+    services: The services to check
+    concurrency: The number of services whose limit values are listed in parallel
+    options: The scan options
+
+    Returns:
+    The same limits and namespace as main
+    """
+    if options == None:
+        options = {}
+    loop = asyncio.get_running_loop()
+    async_concurrency = options.get("async_concurrency", 64)
+    semaphore = asyncio.Semaphore(async_concurrency)
+    with ThreadPoolExecutor(max_workers=async_concurrency) as executor:
+
+        async def call(function, *args):
+            async with semaphore:
+                return await loop.run_in_executor(executor, function, *args)
+
+        tenancy, namespace, scan_regions = await call(prepare_regions, regions, options)
+        limits = await asyncio.gather(*[check_limits_async(tenancy, topic_id, region, percentage, services, concurrency, options, call)
+                                        for region in scan_regions])
+        limits = await call(finish_regions, list(limits), scan_regions, topic_id, percentage, options)
     return limits, namespace
 
 
-def handler(ctx, data: io.BytesIO = None):
-    config = ctx.Config()
+def configure_run(config, deadline=None):
+    """ Parses the function config and resets the counters and the deadline of a run
+
+    Parameters:
+    config: The function config as a dict
+    deadline: The time.monotonic() value by which the run has to finish. None uses the timeout config
+
+    Returns:
+    The regions, topic_id, percentage, services, concurrency and options arguments of main and main_async
+    """
+    global region_cache_ttl
+    global run_deadline
+    global run_end
     percentage = config["percentage"]
     if "regions" in config:
         regions = config["regions"]
@@ -356,19 +2269,268 @@ def handler(ctx, data: io.BytesIO = None):
     else:
         topic_id = config["topic_id"]
 
-    if "services" in config:
-        if ',' not in config["services"]:
-            services = config["services"]
-        else:
-            services = config["services"].split(',')
+    services = LimitFilter.split(config.get("services"))
+
+    if "concurrency" in config:
+        concurrency = int(config["concurrency"])
     else:
-        services = []
+        concurrency = 1
 
+    if "rate_limit" in config or "rate_limit_max" in config:
+        rate_limiter.configure(float(config["rate_limit"]) if "rate_limit" in config else None,
+                               float(config["rate_limit_max"]) if "rate_limit_max" in config else None)
+    rate_limiter.reset_counters()
+
+    if "region_cache_ttl" in config:
+        region_cache_ttl = int(config["region_cache_ttl"])
+
+    if "ad_cache_ttl" in config:
+        expire_ad_cache(int(config["ad_cache_ttl"]))
+    else:
+        expire_ad_cache()
+
+    options = {}
+    options["policies"] = load_policies(
+        config.get("threshold_policies"), int(percentage))
+    options["limit_filter"] = LimitFilter(services, config.get("exclude_services"), config.get(
+        "limits"), config.get("exclude_limits"), config.get("scopes"))
+    if "bucket_name" in config:
+        options["bucket_name"] = config["bucket_name"]
+    if "cold_scan_interval" in config:
+        options["cold_scan_interval"] = int(config["cold_scan_interval"])
+    if "hot_margin" in config:
+        options["hot_margin"] = int(config["hot_margin"])
+    if "region_concurrency" in config:
+        options["region_concurrency"] = int(config["region_concurrency"])
+    if "global_region" in config:
+        options["global_region"] = config["global_region"]
+    if "checkpoint_size" in config:
+        options["checkpoint_size"] = int(config["checkpoint_size"])
+    if "history_days" in config:
+        options["history_days"] = int(config["history_days"])
+    if "forecast_days" in config:
+        options["forecast_days"] = float(config["forecast_days"])
+    if "forecast_min_samples" in config:
+        options["forecast_min_samples"] = int(config["forecast_min_samples"])
+    options["notification_mode"] = config.get("notification_mode", "region")
+    options["digest_alerts"] = {}
+    options["digest_states"] = {}
+    if "async_concurrency" in config:
+        options["async_concurrency"] = int(config["async_concurrency"])
+    if config.get("engine", "threads") == "async":
+        pool_size = options.get("async_concurrency", 64)
+    else:
+        pool_size = concurrency * options.get("region_concurrency", 1)
+    http_pool.configure(int(config.get("http_pool_size", max(pool_size, 10))), int(
+        config.get("http_pool_hosts", http_pool.hosts)))
+    http_pool.reset()
+    if "message_max_bytes" in config:
+        options["message_max_bytes"] = int(config["message_max_bytes"])
+    options["alert_dedup"] = "bucket_name" in config and config.get(
+        "alert_dedup", "true").lower() == "true"
+    if "alert_step" in config:
+        options["alert_step"] = float(config["alert_step"])
+    if "alert_digest_hours" in config:
+        options["alert_digest_hours"] = float(config["alert_digest_hours"])
+
+    outputs = [output.strip() for output in config.get(
+        "results_output", "response").split(',')]
+    options["outputs"] = outputs
+    if "ndjson" in outputs or "object" in outputs:
+        if "object" in outputs:
+            object_name = config.get("results_object", datetime.now(
+                timezone.utc).strftime('results/limits_%Y%m%dT%H%M%S.ndjson'))
+        else:
+            object_name = None
+        options["writer"] = ResultWriter(keep_lines="ndjson" in outputs, bucket_name=config.get("bucket_name"), object_name=object_name,
+                                         part_size=int(config.get("results_part_size", 10 * 1024 * 1024)))
+    options["collect_values"] = "response" in outputs
+    options["result_format"] = config.get("result_format", "records")
+
+    if deadline == None:
+        deadline = time.monotonic() + int(config.get("timeout", 300))
+    run_end = deadline
+    run_deadline = deadline - int(config.get("deadline_margin", 30))
+
+    reset_plan_stats()
+    call_metrics.reset()
     create_log()
+    logger.setLevel(config.get("log_level", "INFO").upper())
+    return regions, topic_id, int(percentage), services, concurrency, options
+
+
+def finish_run(config, options, limits):
+    """ Collects the counters of a run and shapes its result
+
+    Parameters:
+    config: The function config as a dict
+    options: The options returned by configure_run
+    limits: The limits returned by main or main_async
+
+    Returns:
+    The same limits and stats as run
+    """
+    outputs = options["outputs"]
+    stats = {"rate_limiter": dict(rate_limiter.stats(), ons=rate_limiter.stats("ons")),
+             "ad_cache": dict(ad_cache_stats),
+             "plan": dict(plan_stats),
+             "incremental": dict(scan_stats, estimated_saved_seconds=round(scan_stats["estimated_saved_seconds"], 3)),
+             "alerts": dict(alert_stats),
+             "notifications": dict(notification_stats),
+             "http": http_pool.stats(),
+             "calls": call_metrics.stats()}
+    if options.get("writer") != None:
+        stats["results"] = options["writer"].stats()
+    if "metrics_compartment_id" in config:
+        try:
+            post_call_metrics(config["metrics_compartment_id"], config.get(
+                "metrics_namespace", "limits_monitoring"))
+        except Exception as e:
+            logger.info(e)
+    logger.info("[INFO] Limits API calls: {}".format(stats["rate_limiter"]))
+    if "ndjson" in outputs:
+        return options["writer"], stats
+    if options["result_format"] == "columnar":
+        return encode_columnar(limits), stats
+    return limits, stats
+
+
+def run(config, deadline=None):
+    """ Parses the function config and checks the limits of the configured regions
+
+    Parameters:
+    config: The function config as a dict
+    deadline: The time.monotonic() value by which the run has to finish. None uses the timeout config
+
+    Returns:
+    limits - The checked limits as a list of records, encoded by encode_columnar for the columnar
+    result_format, one dict per region for the legacy result_format or a ResultWriter when results_output is ndjson
+
+    stats - The counters of the run
+    """
+    arguments = configure_run(config, deadline)
+    options = arguments[-1]
+    try:
+        if config.get("engine", "threads") == "async":
+                    limits, namespace = asyncio.run(main_async(*arguments))
+        else:
+            limits, namespace = main(*arguments)
+    finally:
+        if options.get("writer") != None:
+            options["writer"].close()
+    return finish_run(config, options, limits)
+
+
+async def run_async(config, deadline=None):
+    """ Runs like run from a coroutine, for callers that already run an event loop like fdk
+
+    The async engine runs on the loop of the caller. The threads engine blocks it, like a
+    regular handler would.
+
+    Parameters:
+    config: The function config as a dict
+    deadline: The time.monotonic() value by which the run has to finish. None uses the timeout config
+
+    Returns:
+    The same limits and stats as run
+    """
+    arguments = configure_run(config, deadline)
+    options = arguments[-1]
+    try:
+        if config.get("engine", "threads") == "async":
+            limits, namespace = await main_async(*arguments)
+        else:
+            limits, namespace = main(*arguments)
+    finally:
+        if options.get("writer") != None:
+            options["writer"].close()
+    return finish_run(config, options, limits)
+
+
+def get_deadline(ctx):
+    """ Converts the deadline of the invocation to a time.monotonic() value
+
+    Parameters:
+    ctx: The fdk invocation context
 
-    limits, namespace = main(regions, topic_id, int(percentage), services)
+    Returns:
+    The deadline or None if the context does not have one
+    """
+    try:
+        deadline = datetime.fromisoformat(
+            ctx.Deadline().replace("Z", "+00:00"))
+        return time.monotonic() + (deadline - datetime.now(timezone.utc)).total_seconds()
+    except Exception:
+        return None
 
+
+async def handler(ctx, data: io.BytesIO = None):
+    limits, stats = await run_async(ctx.Config(), get_deadline(ctx))
+
+    if isinstance(limits, ResultWriter):
+        return response.Response(
+            ctx, response_data=limits.getvalue() + json.dumps({"stats": stats}) + "\n",
+            headers={"Content-Type": "application/x-ndjson"}
+        )
     return response.Response(
-        ctx, response_data=json.dumps(limits),
+        ctx, response_data=json.dumps({"limits": limits, "stats": stats}),
         headers={"Content-Type": "application/json"}
     )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Checks the limits of several regions from a single process")
+
+    parser.add_argument("-topic_id", dest="topic_id", type=str, required=True,
+                        help="The id of the topic used for publishing limit messages \n")
+
+    parser.add_argument("-percentage", dest="percentage", type=str, required=True,
+                        help="The threshold percentage \n")
+
+    parser.add_argument("-regions", dest="regions", type=str, required=False, default="",
+                        help="Comma separated regions to check. Empty checks all of the subscribed regions \n")
+
+    parser.add_argument("-services", dest="services", type=str, required=False,
+                        help="Comma separated services to check, as globs or re: regular expressions \n")
+
+    parser.add_argument("-exclude_services", dest="exclude_services", type=str, required=False,
+                        help="Comma separated services to skip \n")
+
+    parser.add_argument("-limits", dest="limits", type=str, required=False,
+                        help="Comma separated limit names to check \n")
+
+    parser.add_argument("-exclude_limits", dest="exclude_limits", type=str, required=False,
+                        help="Comma separated limit names to skip \n")
+
+    parser.add_argument("-scopes", dest="scopes", type=str, required=False,
+                        help="Comma separated scopes to check (REGION, AD, GLOBAL) \n")
+
+    parser.add_argument("-concurrency", dest="concurrency", type=str, required=False, default="8",
+                        help="The number of limit checks run in parallel in each region \n")
+
+    parser.add_argument("-region_concurrency", dest="region_concurrency", type=str, required=False, default="4",
+                        help="The number of regions checked in parallel \n")
+
+    parser.add_argument("-timeout", dest="timeout", type=str, required=False, default="3600",
+                        help="The number of seconds after which the run stops and publishes what it found \n")
+
+    parser.add_argument("-bucket_name", dest="bucket_name", type=str, required=False,
+                        help="The scheduling bucket used for the usage snapshots \n")
+
+    parser.add_argument("-config_file", dest="config_file", type=str, required=False, default=oci.config.DEFAULT_LOCATION,
+                        help="The OCI config file used instead of the resource principal \n")
+
+    parser.add_argument("-profile", dest="profile", type=str, required=False, default=oci.config.DEFAULT_PROFILE,
+                        help="The profile of the OCI config file \n")
+
+    args = parser.parse_args()
+
+    use_config_file(args.config_file, args.profile)
+    config = {key: value for key, value in vars(args).items()
+              if value != None and key not in ["config_file", "profile"]}
+    limits, stats = run(config)
+    if isinstance(limits, ResultWriter):
+        print(limits.getvalue() + json.dumps({"stats": stats}))
+    else:
+        print(json.dumps({"limits": limits, "stats": stats}, indent=2))
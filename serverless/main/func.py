@@ -1,12 +1,10 @@
 import io
 import json
-import logging
 import oci
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from oci.identity.models import region
-import logging
-import os
+import threading
+import time
 from fdk import response
 
 identity_client = None
@@ -15,9 +13,112 @@ os_client = None
 search_client = None
 invoke_client = None
 
+signer = None
+default_config = {}
+clients = {}
+clients_lock = threading.Lock()
+region_subscriptions = None
+region_cache_ttl = 3600
+invoke_clients = {}
+
+# The client classes are looked up when the first client is created, the oci package only
+# imports a service package on its first access
+CLIENT_CLASSES = {
+    "identity": lambda config, **kwargs: oci.identity.IdentityClient(config, **kwargs),
+    "functions": lambda config, **kwargs: oci.functions.FunctionsManagementClient(config, **kwargs),
+    "object_storage": lambda config, **kwargs: oci.object_storage.ObjectStorageClient(config, **kwargs),
+    "search": lambda config, **kwargs: oci.resource_search.ResourceSearchClient(config, **kwargs),
+    "invoke": lambda config, **kwargs: oci.functions.FunctionsInvokeClient(config, **kwargs)
+}
+
+
+def get_signer():
+    """ Gets the resource principal signer, creating it only on the first call of a container
+
+    Parameters: None
+
+    Returns: The resource principal signer
+    """
+    global signer
+    with clients_lock:
+        if signer == None:
+            signer = oci.auth.signers.get_resource_principals_signer()
+    return signer
+
+
+def use_config_file(file_location=oci.config.DEFAULT_LOCATION, profile_name=oci.config.DEFAULT_PROFILE):
+    """ Makes the clients authenticate with an OCI config file instead of the resource principal
+
+    Parameters:
+    file_location - The path of the OCI config file
+    profile_name - The profile of the OCI config file
+
+    Returns: The signer built from the config file
+    """
+    global signer
+    config = oci.config.from_file(file_location, profile_name)
+    config_signer = oci.signer.Signer(
+        tenancy=config["tenancy"],
+        user=config["user"],
+        fingerprint=config["fingerprint"],
+        private_key_file_location=config.get("key_file"),
+        pass_phrase=config.get("pass_phrase"),
+        private_key_content=config.get("key_content")
+    )
+    config_signer.tenancy_id = config["tenancy"]
+    with clients_lock:
+        signer = config_signer
+        default_config["region"] = config["region"]
+        clients.clear()
+        invoke_clients.clear()
+    return signer
+
+
+def get_client(service, region=None):
+    """ Gets an OCI client from the registry, creating it only the first time it is needed
+
+    Parameters:
+    service - One of the keys of CLIENT_CLASSES
+    region - The region of the client. None uses the region of the signer
+
+    Returns:
+    The client for the service and region
+    """
+    key = (service, region)
+    client = clients.get(key)
+    if client == None:
+        client_signer = get_signer()
+        with clients_lock:
+            client = clients.get(key)
+            if client == None:
+                config = dict(default_config)
+                if region != None:
+                    config["region"] = region
+                client = CLIENT_CLASSES[service](config, signer=client_signer)
+                clients[key] = client
+    return client
+
+
+def get_region_subscriptions(tenancy_id):
+    """ Lists the region subscriptions of the tenancy, reusing the last result for region_cache_ttl seconds
+
+    Parameters:
+    tenancy_id - The id of the tenancy
+
+    Returns:
+    The region subscriptions
+    """
+    global region_subscriptions
+    now = time.monotonic()
+    if region_subscriptions == None or now - region_subscriptions[0] >= region_cache_ttl:
+        data = get_client("identity").list_region_subscriptions(
+            tenancy_id).data
+        region_subscriptions = (now, data)
+    return region_subscriptions[1]
+
 
 def initialize(region=None):
-    """Creates OCI python sdk clients
+    """Gets the OCI python sdk clients from the client registry
 
     Parameters:
     region - the region in which you want to spawn the config
@@ -27,27 +128,22 @@ def initialize(region=None):
     identity_client - Client used for making IAM requests
     """
 
-    signer = oci.auth.signers.get_resource_principals_signer()
+    signer = get_signer()
 
     global identity_client
     global fn_mgmt_client
     global os_client
     global search_client
     global invoke_client
-    identity_client = oci.identity.IdentityClient({}, signer=signer)
-    regions = identity_client.list_region_subscriptions(signer.tenancy_id)
 
-    home_region = [i for i in regions.data if i.is_home_region == True]
+    home_region = [i for i in get_region_subscriptions(
+        signer.tenancy_id) if i.is_home_region == True]
     home_region_name = home_region[0].region_name
 
-    identity_client = oci.identity.IdentityClient(
-        config={"region": home_region_name}, signer=signer)
-    fn_mgmt_client = oci.functions.FunctionsManagementClient(
-        config={"region": home_region_name}, signer=signer)
-    os_client = oci.object_storage.ObjectStorageClient(
-        config={"region": home_region_name}, signer=signer)
-    search_client = oci.resource_search.ResourceSearchClient(
-        config={"region": home_region_name}, signer=signer)
+    identity_client = get_client("identity", home_region_name)
+    fn_mgmt_client = get_client("functions", home_region_name)
+    os_client = get_client("object_storage", home_region_name)
+    search_client = get_client("search", home_region_name)
     return signer, identity_client, fn_mgmt_client, os_client, search_client
 
 
@@ -102,34 +198,241 @@ def put_object(namespace_name, bucket_name, object_name, put_object_body):
                          object_name, put_object_body)
 
 
-def handler(ctx, data: io.BytesIO = None):
+def get_invoke_client(invoke_endpoint):
+    """ Gets the invoke client of an endpoint, creating it only the first time it is needed
+
+    Parameters:
+    invoke_endpoint - The invoke endpoint of the function
+
+    Returns:
+    The FunctionsInvokeClient for the endpoint
+    """
+    client = invoke_clients.get(invoke_endpoint)
+    if client == None:
+        client_signer = get_signer()
+        with clients_lock:
+            client = invoke_clients.get(invoke_endpoint)
+            if client == None:
+                client = CLIENT_CLASSES["invoke"](
+                    dict(default_config), service_endpoint=invoke_endpoint, signer=client_signer)
+                invoke_clients[invoke_endpoint] = client
+    return client
+
+
+def get_object(namespace_name, bucket_name, object_name):
+    """ Gets an object from object storage
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the object
+
+    Returns:
+    The content of the object or None if the object does not exist
+    """
+    try:
+        return os_client.get_object(namespace_name, bucket_name, object_name).data.content
+    except oci.exceptions.ServiceError as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def build_manifest(fn_prefix):
+    """ Builds the function manifest by searching the functions and getting their invoke endpoints
+
+    Parameters:
+    fn_prefix - The name prefix of the regional functions
+
+    Returns:
+    A list of dicts with the name, id and invoke_endpoint of every function
+    """
+    manifest = []
+    for fn in get_functions(str(fn_prefix)).items:
+        fn_details = fn_mgmt_client.get_function(fn.identifier).data
+        manifest.append({"name": fn.display_name, "id": fn.identifier,
+                         "invoke_endpoint": fn_details.invoke_endpoint})
+    return manifest
+
+
+def load_manifest(namespace_name, bucket_name, object_name, fn_prefix):
+    """ Reads the function manifest from the bucket, building and storing it if it is missing
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the manifest object
+    fn_prefix - The name prefix of the regional functions
+
+    Returns:
+    A list of dicts with the name, id and invoke_endpoint of every function
+    """
+    try:
+        content = get_object(namespace_name, bucket_name, object_name)
+    except Exception as e:
+        print(e)
+        content = None
+    if content != None:
+        manifest = json.loads(content)
+        if manifest.get("fn_prefix") == fn_prefix:
+            return manifest["functions"]
+    return refresh_manifest(namespace_name, bucket_name, object_name, fn_prefix)
+
+
+def refresh_manifest(namespace_name, bucket_name, object_name, fn_prefix):
+    """ Rebuilds the function manifest from search and stores it in the bucket
+
+    Parameters:
+    namespace_name: The name of the namespace
+    bucket_name: The name of the bucket
+    object_name: The name of the manifest object
+    fn_prefix - The name prefix of the regional functions
+
+    Returns:
+    A list of dicts with the name, id and invoke_endpoint of every function
+    """
+    print("[INFO] Building the function manifest from search.")
+    functions = build_manifest(fn_prefix)
+    try:
+        put_object(namespace_name, bucket_name, object_name,
+                   json.dumps({"fn_prefix": fn_prefix, "functions": functions}))
+    except Exception as e:
+        print(e)
+    return functions
+
+
+def dispatch_function(fn):
+    """ Invokes a function detached
+
+    Parameters:
+    fn - A manifest entry with the name, id and invoke_endpoint of the function
+
+    Returns:
+    A dict with the function name, id, status and duration of the dispatch
+    """
+    start = time.monotonic()
+    report = {"function": fn["name"], "id": fn["id"]}
+    try:
+        invoke_endpoint = fn.get("invoke_endpoint")
+        if invoke_endpoint == None:
+            invoke_endpoint = fn_mgmt_client.get_function(
+                fn["id"]).data.invoke_endpoint
+        print("Invoking fn {} with id {}".format(fn["name"], fn["id"]))
+        get_invoke_client(invoke_endpoint).invoke_function(
+            fn["id"], fn_invoke_type="detached")
+        report["status"] = "invoked"
+    except Exception as e:
+        print(e)
+        if getattr(e, "status", None) == 404:
+            report["status"] = "not_found"
+        else:
+            report["status"] = "failed"
+        report["error"] = str(e)
+    report["seconds"] = round(time.monotonic() - start, 3)
+    return report
+
+
+def dispatch_functions(functions, concurrency=16):
+    """ Dispatches the regional functions concurrently
+
+    Parameters:
+    functions - A list of manifest entries
+    concurrency - The number of functions dispatched in parallel
+
+    Returns:
+    A list with the dispatch report of every function, in the same order as functions
+    """
+    if concurrency <= 1 or len(functions) <= 1:
+        return [dispatch_function(fn) for fn in functions]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(functions))) as executor:
+        return list(executor.map(dispatch_function, functions))
+
+
+def is_scheduling_event(data):
+    """ Checks if the function was triggered by the deletion of the scheduling object
+
+    Parameters:
+    data: The body of the invocation
+
+    Returns:
+    True for manual invocations and for events about main.txt, False for the other objects of the bucket
+    """
+    try:
+        event = json.loads(data.getvalue())
+    except Exception:
+        return True
+    if not isinstance(event, dict) or not isinstance(event.get("data"), dict):
+        return True
+    resource_name = event["data"].get("resourceName")
+    return resource_name == None or resource_name == "main.txt"
+
+
+def run(fn_config):
+    """ Dispatches the regional functions and writes the dispatch report to main.txt
+
+    Parameters:
+    fn_config: The function config as a dict
+
+    Returns:
+    The dispatch summary
+    """
+    global region_cache_ttl
+    if "region_cache_ttl" in fn_config:
+        region_cache_ttl = int(fn_config["region_cache_ttl"])
+
     signer, identity_client, fn_mgmt_client, os_client, search_client = initialize()
     namespace = os_client.get_namespace().data
 
-    fn_config = ctx.Config()
     bucket_name = fn_config["bucket_name"]
     fn_prefix = fn_config["fn_prefix"]
-    fn = get_functions(str(fn_prefix))
-
-    required_fn = [{fn.display_name: fn.identifier}
-                   for fn in fn.items]
-
-    for fn in required_fn:
-        for key, value in fn.items():
-            fn_details = fn_mgmt_client.get_function(value).data
-            invoke_client = oci.functions.FunctionsInvokeClient(
-                {}, service_endpoint=fn_details.invoke_endpoint, signer=signer)
-            print("Invoking fn {} with id {}".format(key, value))
-            invoke_client.invoke_function(value, fn_invoke_type="detached")
+    if "manifest_object" in fn_config:
+        manifest_object = fn_config["manifest_object"]
+    else:
+        manifest_object = "fn_manifest.json"
+
+    if "dispatch_concurrency" in fn_config:
+        dispatch_concurrency = int(fn_config["dispatch_concurrency"])
+    else:
+        dispatch_concurrency = 16
+
+    start = time.monotonic()
+    required_fn = load_manifest(
+        namespace, bucket_name, manifest_object, fn_prefix)
+    report = dispatch_functions(required_fn, dispatch_concurrency)
+
+    stale = [fn["function"] for fn in report if fn["status"] == "not_found"]
+    if len(stale) > 0:
+        required_fn = refresh_manifest(
+            namespace, bucket_name, manifest_object, fn_prefix)
+        retried = dispatch_functions(
+            [fn for fn in required_fn if fn["name"] in stale], dispatch_concurrency)
+        report = [fn for fn in report if fn["status"]
+                  != "not_found"] + retried
+    summary = {
+        "invoked": len([fn for fn in report if fn["status"] == "invoked"]),
+        "failed": len([fn for fn in report if fn["status"] != "invoked"]),
+        "seconds": round(time.monotonic() - start, 3),
+        "functions": report
+    }
 
     try:
-        put_object(namespace, bucket_name, "main.txt", "Limit scheduler")
+        put_object(namespace, bucket_name, "main.txt", json.dumps(summary))
     except Exception as e:
         print(e)
         if e.status == 429:
             raise
+    return summary
+
+
+def handler(ctx, data: io.BytesIO = None):
+    if data != None and not is_scheduling_event(data):
+        return response.Response(
+            ctx, response_data=json.dumps({"Skipped": "not a scheduling event"}),
+            headers={"Content-Type": "application/json"}
+        )
 
+    summary = run(ctx.Config())
     return response.Response(
-        ctx, response_data=json.dumps({"Success": "200"}),
+        ctx, response_data=json.dumps({"Success": "200", "dispatch": summary}),
         headers={"Content-Type": "application/json"}
     )
@@ -38,6 +38,13 @@ resource "oci_objectstorage_object_lifecycle_policy" "this" {
       name        = rule.value.rule_name
       time_amount = rule.value.time_amount
       time_unit   = rule.value.time_unit
+
+      dynamic "object_name_filter" {
+        for_each = length(rule.value.inclusion_prefixes) == 0 ? [] : [rule.value.inclusion_prefixes]
+        content {
+          inclusion_prefixes = object_name_filter.value
+        }
+      }
     }
   }
 }
@@ -32,6 +32,7 @@ variable "objectlifecycle_params" {
       rule_name   = string
       time_amount = number
       time_unit   = string
+      inclusion_prefixes = optional(list(string), [])
     }))
   }))
 }